@@ -1,66 +1,174 @@
+# cython: language_level=2, boundscheck=False, wraparound=False, cdivision=True
 
-def distance(float x1, float y1, float x2, float y2):
+from cpython cimport array
+from libc.math cimport sqrt, INFINITY
+
+import array
+
+
+def distance(double x1, double y1, double x2, double y2):
     "Pythagorean distance"
-    return ((x1-x2)**2 + (y1-y2)**2)**0.5
+    return sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
+
+
+cdef inline bint before(double[::1] xs, double[::1] ys, long a, long b):
+    # Order by x, then y, then index, so that ties are deterministic
+    if xs[a] != xs[b]:
+        return xs[a] < xs[b]
+    if ys[a] != ys[b]:
+        return ys[a] < ys[b]
+    return a < b
+
+
+cdef void sort(double[::1] xs, double[::1] ys, long[::1] order,
+               long[::1] tmp):
+    "Bottom-up merge sort of the positions in order, by xs then ys."
+    cdef Py_ssize_t n = order.shape[0], width = 1, lo, mid, hi, a, b, k
+    while width < n:
+        lo = 0
+        while lo < n:
+            mid = min(lo + width, n)
+            hi = min(lo + 2 * width, n)
+            a = lo
+            b = mid
+            for k in range(lo, hi):
+                if b >= hi or (a < mid and before(xs, ys, order[a],
+                                                  order[b])):
+                    tmp[k] = order[a]
+                    a += 1
+                else:
+                    tmp[k] = order[b]
+                    b += 1
+            lo = hi
+        for k in range(n):
+            order[k] = tmp[k]
+        width *= 2
+
+
+cdef struct Pair:
+    double d2
+    long i
+    long j
+
+
+cdef inline void check(double[::1] xs, double[::1] ys, long a, long b,
+                       Pair *best):
+    cdef double dx = xs[a] - xs[b]
+    cdef double dy = ys[a] - ys[b]
+    cdef double d2 = dx * dx + dy * dy
+    if d2 < best.d2:
+        best.d2 = d2
+        best.i = a
+        best.j = b
+
+
+cdef void recurse(double[::1] xs, double[::1] ys, long[::1] by_x,
+                  long[::1] by_y, long[::1] tmp, signed char[::1] left,
+                  Py_ssize_t lo, Py_ssize_t hi, Pair *best):
+    """
+    Closest pair among the points by_x[lo:hi]. by_y[lo:hi] holds the same
+    points sorted by y, and is sorted again when this returns.
+    """
+    cdef Py_ssize_t n = hi - lo, mid = lo + n // 2, k, a, b, count
+    cdef double mid_x, dx, dy
+
+    if n <= 3:
+        for a in range(lo, hi):
+            for b in range(a + 1, hi):
+                check(xs, ys, by_x[a], by_x[b], best)
+        return
+
+    # Split the y order in two, keeping each half sorted by y
+    for k in range(lo, mid):
+        left[by_x[k]] = 1
+    for k in range(mid, hi):
+        left[by_x[k]] = 0
+    a = lo
+    b = mid
+    for k in range(lo, hi):
+        if left[by_y[k]]:
+            tmp[a] = by_y[k]
+            a += 1
+        else:
+            tmp[b] = by_y[k]
+            b += 1
+    for k in range(lo, hi):
+        by_y[k] = tmp[k]
+
+    recurse(xs, ys, by_x, by_y, tmp, left, lo, mid, best)
+    recurse(xs, ys, by_x, by_y, tmp, left, mid, hi, best)
+
+    # Merge the two halves back into y order
+    a = lo
+    b = mid
+    for k in range(lo, hi):
+        if b >= hi or (a < mid and before(ys, xs, by_y[a], by_y[b])):
+            tmp[k] = by_y[a]
+            a += 1
+        else:
+            tmp[k] = by_y[b]
+            b += 1
+    for k in range(lo, hi):
+        by_y[k] = tmp[k]
+
+    # Look for closer pairs straddling the split line
+    mid_x = xs[by_x[mid]]
+    count = 0
+    for k in range(lo, hi):
+        dx = xs[by_y[k]] - mid_x
+        if dx * dx < best.d2:
+            tmp[lo + count] = by_y[k]
+            count += 1
+    for a in range(count):
+        for b in range(a + 1, count):
+            dy = ys[tmp[lo + b]] - ys[tmp[lo + a]]
+            if dy * dy >= best.d2:
+                break
+            check(xs, ys, tmp[lo + a], tmp[lo + b], best)
+
+
+def closest_indices(xs, ys, index=None):
+    """
+    Returns the closest pair of points as (distance, i, j), where i and j
+    are positions in the xs and ys arrays.
+
+    @param xs: Contiguous array of doubles (e.g. array.array('d')).
+    @param ys: Same, for the y coordinates.
+    @param index: Optional positions of the points to consider; defaults
+                  to all of them.
+    """
+    cdef double[::1] x_view = xs
+    cdef double[::1] y_view = ys
+    if index is None:
+        index = range(len(xs))
+    if len(index) < 2:
+        raise ValueError("Single or empty points set")
+
+    order = array.array('l', index)
+    cdef long[::1] by_x = order
+    cdef long[::1] by_y = array.copy(order)
+    cdef long[::1] tmp = array.copy(order)
+    # Presort once by x and once by y
+    sort(x_view, y_view, by_x, tmp)
+    sort(y_view, x_view, by_y, tmp)
+    cdef signed char[::1] left = array.array('b', [0]) * len(xs)
+    cdef Pair best
+    best.d2 = INFINITY
+    best.i = best.j = -1
+
+    recurse(x_view, y_view, by_x, by_y, tmp, left, 0, by_x.shape[0], &best)
+    return sqrt(best.d2), best.i, best.j
+
 
 def closest_pair(list points):
     """
     Returns the closest pair of points as (distance, (x, y, data), (x2, y2, data2)).
-    
+
     @param points: A list of triples (x, y, data)
     """
-    
-    cdef float min_d
-    
     if len(points) < 2:
         raise ValueError("Single or empty points set")
-    elif 2 <= len(points) <= 6: # 6 seems about the sweet spot
-        min_d = 0
-        min_p1 = None
-        min_p2 = None
-        for i, point in enumerate(points):
-            for point2 in points[i+1:]:
-                d = distance(point[0], point[1], point2[0], point2[1])
-                if min_d == 0 or min_d > d:
-                    min_d = d
-                    min_p1 = point
-                    min_p2 = point2
-        return min_d, min_p1, min_p2
-    else:
-        points.sort()
-        # Split into two subproblems
-        split = int(len(points) / 2)
-        d1, p11, p12 = closest_pair(points[:split])
-        d2, p21, p22 = closest_pair(points[split:])
-        d = min(d1, d2)
-        # Merge (see: http://web.archive.org/web/20080207223230/http://www.cs.mcgill.ca/~cs251/ClosestPair/ClosestPairDQ.html)
-        points_in_strip = []
-        split_at = (points[split-1][0] + points[split][0]) / 2.0
-        for point in points:
-            if point[0] < (split_at-d):
-                continue
-            elif point[0] > (split_at+d):
-                break
-            points_in_strip.append((point[1], point[0], point[2]))
-        # Sort by y
-        points_in_strip.sort()
-        # Now check all points in strip
-        min_d = 0
-        min_p1 = None
-        min_p2 = None
-        max_i = len(points_in_strip)
-        for (i, point) in enumerate(points_in_strip):
-            for point2 in points_in_strip[i+1:min(max_i, i+7)]:
-                sd = distance(point[0], point[1], point2[0], point2[1])
-                if min_d == 0 or min_d > sd:
-                    min_d = sd
-                    min_p1 = (point[1], point[0], point[2])
-                    min_p2 = (point2[1], point2[0], point2[2])
-        if min_d != 0 and min_d < d:
-            return min_d, min_p1, min_p2
-        elif d1 < d2:
-            return d1, p11, p12
-        else:
-            return d2, p21, p22
-    
-    
\ No newline at end of file
+    xs = array.array('d', [point[0] for point in points])
+    ys = array.array('d', [point[1] for point in points])
+    d, i, j = closest_indices(xs, ys)
+    return d, points[i], points[j]
@@ -1,18 +1,36 @@
+import resource
 import time
+from array import array
 
-from clusterlizard.closestpair import closest_pair, distance
+try:
+    from .closestpair import closest_indices, closest_pair, distance  # noqa
+except ImportError:
+    from .pyclosestpair import closest_indices, closest_pair, distance  # noqa
 
 
 def mean(l):
     return sum(l) / float(len(l))
 
 
+def peak_rss():
+    "Peak resident set size of the current process, in megabytes."
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
 class Cluster(object):
 
     def __init__(self, iterable):
         self.points = set(iterable)
         self.mean = self._mean()
 
+    @classmethod
+    def from_point(cls, x, y, d):
+        return cls([(x, y, d)])
+
+    @property
+    def ids(self):
+        return [d for x, y, d in self.points]
+
     def _mean(self):
         xs, ys = [], []
         for x, y, d in self.points:
@@ -30,50 +48,132 @@ class Cluster(object):
         return len(self.points)
 
 
+class CompactCluster(object):
+    """
+    A leaner Cluster: only the member count, the running sums of their
+    coordinates and an array of their ids are kept, so merging doesn't have
+    to rebuild a set of points or recompute the mean from scratch.
+
+    Merging hands the larger cluster's id array over to the new cluster,
+    which means merged clusters must not be used afterwards.
+    """
+    __slots__ = ('count', 'sum_x', 'sum_y', 'ids', 'mean')
+
+    def __init__(self, count, sum_x, sum_y, ids):
+        self.count = count
+        self.sum_x = sum_x
+        self.sum_y = sum_y
+        self.ids = ids
+        self.mean = sum_x / count, sum_y / count
+
+    @classmethod
+    def from_point(cls, x, y, d):
+        return cls(1, float(x), float(y), array('l', [d]))
+
+    def merge(self, other):
+        if self.count < other.count:
+            big, small = other, self
+        else:
+            big, small = self, other
+        ids = big.ids
+        ids.extend(small.ids)
+        big.ids = small.ids = None
+        return CompactCluster(self.count + other.count,
+                              self.sum_x + other.sum_x,
+                              self.sum_y + other.sum_y, ids)
+
+    def distance(self, other):
+        return distance(self.mean[0], self.mean[1],
+                        other.mean[0], other.mean[1])
+
+    def __len__(self):
+        return self.count
+
+
 class Clusterer(object):
 
-    def __init__(self, input, output, progress=None, separation=75):
+    def __init__(self, input, output, progress=None, separation=75,
+                 cluster_class=Cluster, stats=None, progress_interval=1):
         self.input = input
         self.output = output
         self.progress = progress
         self.separation = separation
+        self.cluster_class = cluster_class
+        self.stats = stats
+        self.progress_interval = progress_interval
+        self.last_progress = None
+        self.merges = 0
+        self.rebuilds = 0
+
+    def max_separation(self, zoom):
+        "Returns the distance, in metres, below which clusters get merged."
+        m_per_pixel = (40075016.68 / 2 ** zoom) / 256
+        return m_per_pixel * self.separation
+
+    def report(self, i, clusters, took, zoom):
+        """
+        Passes the merge statistics on to the progress callback, if any, at
+        most once every 'progress_interval' seconds.
+        """
+        if not self.progress:
+            return
+        now = time.time()
+        if (self.last_progress is not None and
+                now - self.last_progress < self.progress_interval):
+            return
+        self.last_progress = now
+        eta = took * (len(clusters) - 10) * 0.7
+        eta = "%i:%i" % (eta / 60, eta % 60)
+        self.progress(i, len(clusters) - 1, took, zoom, eta)
 
     def run(self):
         "Runs the cluster analysis."
 
-        clusters = set(Cluster([(x, y, d)]) for x, y, d in self.input)
+        clusters = set(self.cluster_class.from_point(x, y, d)
+                       for x, y, d in self.input)
 
-        d = 0
-        i = 0
-        zoom = 17
+        for zoom in range(17, -1, -1):
+            start = time.time()
+            merges, rebuilds = self.merges, self.rebuilds
+            clusters = self.cluster_zoom(clusters, zoom)
+            took = time.time() - start
+            self.output(clusters, zoom)
+            if self.stats:
+                self.stats({
+                    'zoom': zoom,
+                    'merges': self.merges - merges,
+                    'seconds': took,
+                    'output_seconds': time.time() - start - took,
+                    'clusters': len(clusters),
+                    'index_rebuilds': self.rebuilds - rebuilds,
+                    'peak_rss_mb': peak_rss(),
+                })
+
+    def cluster_zoom(self, clusters, zoom):
+        """
+        Merges the clusters of the zoom level above until none are closer
+        than the separation at 'zoom'. Returns the new set of clusters.
+        """
+        # Work out what separation is at this zoom
+        max_sep = self.max_separation(zoom)
         tooks = []
 
-        while zoom >= 0:
-            # Work out what separation is at this zoom
-            m_per_pixel = (40075016.68 / 2 ** zoom) / 256
-            max_sep = m_per_pixel * self.separation
-            # Keep going until clusters are far apart or not very numerous.
-
-            while d < max_sep and len(clusters) > 1:
-                s = time.time()
-                # Use closest-pair to find the closest two clusters
-                d, (x1, y1, c1), (x2, y2, c2) = closest_pair(
-                    [(c.mean[0], c.mean[1], c) for c in clusters]
-                )
-                if d >= max_sep:
-                    break
-                # Merge them in the set
-                cn = c1.merge(c2)
-                clusters.discard(c1)
-                clusters.discard(c2)
-                clusters.add(cn)
-                # Calculate stats
-                i += 1
-                tooks = [time.time() - s] + tooks[:2]
-                took = mean(tooks)
-                eta = took * (len(clusters) - 10) * 0.7
-                eta = "%i:%i" % (eta / 60, eta % 60)
-                if self.progress:
-                    self.progress(i, len(clusters) - 1, took, zoom, eta)
-            self.output(clusters, zoom)
-            zoom -= 1
+        # Keep going until clusters are far apart or not very numerous.
+        while len(clusters) > 1:
+            s = time.time()
+            # Use closest-pair to find the closest two clusters
+            d, (x1, y1, c1), (x2, y2, c2) = closest_pair(
+                [(c.mean[0], c.mean[1], c) for c in clusters]
+            )
+            if d >= max_sep:
+                break
+            # Merge them in the set
+            cn = c1.merge(c2)
+            clusters.discard(c1)
+            clusters.discard(c2)
+            clusters.add(cn)
+            # Calculate stats
+            self.merges += 1
+            tooks = [time.time() - s] + tooks[:2]
+            self.report(self.merges, clusters, mean(tooks), zoom)
+        return clusters
@@ -0,0 +1,52 @@
+import math
+import time
+
+from .clusterer import Clusterer
+
+# Spherical mercator coordinates range from -ORIGIN to ORIGIN on both axes
+ORIGIN = 20037508.34
+
+
+class GridClusterer(Clusterer):
+    """
+    Hierarchical grid clustering. Instead of agglomerating pairs, each zoom
+    level's clusters are the clusters of the zoom level above bucketed into
+    a grid whose cells are 'separation' pixels wide at that zoom.
+
+    Cells are anchored on the edge of the map and halve in size with every
+    zoom level, so a cell always contains exactly four cells of the next
+    zoom level: a cluster at a given zoom is made of all the points falling
+    in its cell. The whole run is linear in the number of points per zoom.
+    """
+
+    def cell(self, point, zoom):
+        "Returns the (column, row) of the grid cell containing point."
+        size = self.max_separation(zoom)
+        return (int(math.floor((point[0] + ORIGIN) / size)),
+                int(math.floor((point[1] + ORIGIN) / size)))
+
+    def bounds(self, cell, zoom):
+        "Returns the (x1, y1, x2, y2) mercator bounds of a grid cell."
+        size = self.max_separation(zoom)
+        return (cell[0] * size - ORIGIN, cell[1] * size - ORIGIN,
+                (cell[0] + 1) * size - ORIGIN, (cell[1] + 1) * size - ORIGIN)
+
+    def cluster_zoom(self, clusters, zoom):
+        s = time.time()
+        cells = {}
+        for cluster in clusters:
+            cells.setdefault(self.cell(cluster.mean, zoom), []).append(cluster)
+        self.rebuilds += 1
+        clusters = set()
+        merges = 0
+        for members in cells.values():
+            cluster = members[0]
+            for other in members[1:]:
+                cluster = cluster.merge(other)
+            merges += len(members) - 1
+            clusters.add(cluster)
+        if merges:
+            self.merges += merges
+            self.report(self.merges, clusters, (time.time() - s) / merges,
+                        zoom)
+        return clusters
@@ -0,0 +1,172 @@
+import heapq
+import itertools
+import math
+import time
+
+from .clusterer import Clusterer, mean
+
+
+class GridIndex(object):
+    """
+    A uniform grid of cluster means. As long as cells are at least as big
+    as the search radius, every neighbour within that radius lives in one of
+    the nine cells around a cluster.
+
+    Cells holding more than CAPACITY clusters are split into four, and so
+    on down to MAX_DEPTH levels, so that searching around dense spots
+    doesn't scan every cluster in them. Cells are keyed by (level, x, y).
+    """
+    CAPACITY = 16
+    MAX_DEPTH = 24
+
+    def __init__(self, size):
+        self.size = float(size)
+        # Cells holding clusters, and cells that have been split
+        self.cells = {}
+        self.split = set()
+
+    def cell(self, point, level=0):
+        size = self.size / 2 ** level
+        return (level, int(math.floor(point[0] / size)),
+                int(math.floor(point[1] / size)))
+
+    def leaf(self, point):
+        "Returns the key of the unsplit cell a point falls in."
+        key = self.cell(point)
+        while key in self.split:
+            key = self.cell(point, key[0] + 1)
+        return key
+
+    def add(self, cluster):
+        key = self.leaf(cluster.mean)
+        cell = self.cells.setdefault(key, set())
+        cell.add(cluster)
+        if len(cell) > self.CAPACITY and key[0] < self.MAX_DEPTH:
+            del self.cells[key]
+            self.split.add(key)
+            for other in cell:
+                self.add(other)
+
+    def remove(self, cluster):
+        key = self.leaf(cluster.mean)
+        cell = self.cells[key]
+        cell.discard(cluster)
+        if not cell:
+            del self.cells[key]
+
+    def box_distance(self, point, key):
+        "Returns the distance from a point to the closest edge of a cell."
+        level, gx, gy = key
+        size = self.size / 2 ** level
+        dx = max(gx * size - point[0], 0, point[0] - (gx + 1) * size)
+        dy = max(gy * size - point[1], 0, point[1] - (gy + 1) * size)
+        return math.hypot(dx, dy)
+
+    def nearest(self, cluster, max_d):
+        """
+        Returns (distance, other) for the cluster closest to 'cluster',
+        or None if there is nothing closer than max_d.
+        """
+        x, y = point = cluster.mean
+        best = [max_d, None]
+
+        def visit(key):
+            if key in self.split:
+                level, gx, gy = key
+                children = [(self.box_distance(point, child), child)
+                            for child in [(level + 1, 2 * gx + i, 2 * gy + j)
+                                          for i in (0, 1) for j in (0, 1)]]
+                for d, child in sorted(children):
+                    if d >= best[0]:
+                        break
+                    visit(child)
+                return
+            for other in self.cells.get(key, ()):
+                if other is cluster:
+                    continue
+                d = math.hypot(x - other.mean[0], y - other.mean[1])
+                if d < best[0]:
+                    best[:] = [d, other]
+
+        _, cx, cy = self.cell(point)
+        around = [(0, gx, gy) for gx in (cx - 1, cx, cx + 1)
+                  for gy in (cy - 1, cy, cy + 1)]
+        for d, key in sorted((self.box_distance(point, key), key)
+                             for key in around):
+            if d < best[0]:
+                visit(key)
+        if best[1] is None:
+            return None
+        return tuple(best)
+
+
+class IndexedClusterer(Clusterer):
+    """
+    Same agglomeration as Clusterer, but instead of running closest-pair over
+    every cluster after each merge, it keeps a grid index of cluster means
+    and a heap of each cluster's nearest neighbour. A merge only costs a
+    neighbour search around the new cluster; stale heap entries (pointing at
+    clusters that have since been merged) are refreshed when they surface.
+    """
+
+    def merge_coincident(self, clusters):
+        """
+        Merges clusters with the exact same mean, which closest-pair would
+        merge first anyway. No index can tell them apart.
+        """
+        by_mean = {}
+        for cluster in clusters:
+            by_mean.setdefault(cluster.mean, []).append(cluster)
+        for same in by_mean.values():
+            if len(same) > 1:
+                merged = same[0]
+                for cluster in same[1:]:
+                    merged = merged.merge(cluster)
+                    self.merges += 1
+                clusters.difference_update(same)
+                clusters.add(merged)
+        return clusters
+
+    def cluster_zoom(self, clusters, zoom):
+        max_sep = self.max_separation(zoom)
+        clusters = self.merge_coincident(clusters)
+        # Separation doubles at every zoom level, so the index is rebuilt
+        # with cells matching the new search radius.
+        index = GridIndex(max_sep)
+        for cluster in clusters:
+            index.add(cluster)
+        self.rebuilds += 1
+        heap = []
+        tooks = []
+        counter = itertools.count()
+
+        def push(cluster):
+            found = index.nearest(cluster, max_sep)
+            if found is not None:
+                heapq.heappush(heap, (found[0], next(counter),
+                                      cluster, found[1]))
+
+        for cluster in clusters:
+            push(cluster)
+
+        while heap and len(clusters) > 1:
+            s = time.time()
+            d, _, c1, c2 = heapq.heappop(heap)
+            if c1 not in clusters:
+                continue
+            if c2 not in clusters:
+                # Its neighbour was merged away, look again
+                push(c1)
+                continue
+            cn = c1.merge(c2)
+            for cluster in (c1, c2):
+                index.remove(cluster)
+                clusters.discard(cluster)
+            index.add(cn)
+            clusters.add(cn)
+            push(cn)
+            # Calculate stats
+            self.merges += 1
+            tooks = [time.time() - s] + tooks[:2]
+            self.report(self.merges, clusters, mean(tooks), zoom)
+        return clusters
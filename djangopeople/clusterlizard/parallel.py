@@ -0,0 +1,116 @@
+import multiprocessing
+import time
+
+from .clusterer import Cluster, Clusterer
+from .indexed import IndexedClusterer
+
+
+def split(clusters, gap, axis):
+    """
+    Sorts clusters along one axis and cuts them wherever two consecutive
+    means are more than 'gap' apart.
+    """
+    groups = []
+    last = None
+    for cluster in sorted(clusters, key=lambda c: c.mean[axis]):
+        if last is None or cluster.mean[axis] - last > gap:
+            groups.append([])
+        groups[-1].append(cluster)
+        last = cluster.mean[axis]
+    return groups
+
+
+def partition(clusters, gap):
+    """
+    Splits clusters into groups separated by more than 'gap' along the x
+    axis, then along the y axis. Clusters from different groups are always
+    more than 'gap' apart, and so are means of clusters merged inside each
+    group, so groups can be clustered independently at that separation.
+    """
+    return [group for column in split(clusters, gap, 0)
+            for group in split(column, gap, 1)]
+
+
+def cluster_partitions(args):
+    "Worker: clusters each partition of a batch with a serial engine."
+    engine, separation, cluster_class, partitions, zoom = args
+    clusterer = engine(None, None, separation=separation,
+                       cluster_class=cluster_class)
+    clusters = []
+    for members in partitions:
+        clusters.extend(clusterer.cluster_zoom(set(members), zoom))
+    return clusters, clusterer.merges, clusterer.rebuilds
+
+
+class ParallelClusterer(Clusterer):
+    """
+    Runs a serial engine over a pool of worker processes. At each zoom level
+    the clusters are partitioned on gaps wider than the separation (oceans,
+    empty countryside) and the partitions are merged in parallel. Nothing is
+    ever merged across a gap, so the output is the same as the serial engine.
+
+    As the separation grows the partitions merge into each other; once there
+    is only one left, the remaining (small) zoom levels run in-process.
+    """
+
+    def __init__(self, input, output, progress=None, separation=75,
+                 cluster_class=Cluster, stats=None, progress_interval=1,
+                 engine=IndexedClusterer, workers=None):
+        super(ParallelClusterer, self).__init__(
+            input, output, progress, separation, cluster_class, stats,
+            progress_interval)
+        self.engine = engine
+        self.workers = workers or multiprocessing.cpu_count()
+
+    def run(self):
+        "Runs the cluster analysis."
+        self.pool = multiprocessing.Pool(self.workers)
+        try:
+            super(ParallelClusterer, self).run()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def batches(self, partitions):
+        """
+        Spreads partitions over a few batches per worker, biggest first, so
+        that workers get similar amounts of clusters to merge.
+        """
+        batches = [[0, []] for i in range(self.workers * 4)]
+        for members in sorted(partitions, key=len, reverse=True):
+            batch = min(batches, key=lambda b: b[0])
+            batch[0] += len(members)
+            batch[1].append(members)
+        return [members for size, members in batches if members]
+
+    def cluster_zoom(self, clusters, zoom):
+        s = time.time()
+        partitions = partition(clusters, self.max_separation(zoom))
+        busy = [members for members in partitions if len(members) > 1]
+        if len(busy) < 2:
+            serial = self.engine(None, None, self.progress, self.separation,
+                                 cluster_class=self.cluster_class,
+                                 progress_interval=self.progress_interval)
+            serial.merges = self.merges
+            serial.last_progress = self.last_progress
+            clusters = serial.cluster_zoom(clusters, zoom)
+            self.merges = serial.merges
+            self.rebuilds += serial.rebuilds
+            self.last_progress = serial.last_progress
+            return clusters
+
+        jobs = [(self.engine, self.separation, self.cluster_class, batch, zoom)
+                for batch in self.batches(busy)]
+        clusters = set(members[0] for members in partitions
+                       if len(members) == 1)
+        merges = 0
+        for merged, count, rebuilds in self.pool.imap_unordered(
+                cluster_partitions, jobs):
+            clusters.update(merged)
+            merges += count
+            self.rebuilds += rebuilds
+        if merges:
+            self.merges += merges
+            self.report(self.merges, clusters, (time.time() - s) / merges,
+                        zoom)
+        return clusters
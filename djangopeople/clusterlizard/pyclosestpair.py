@@ -0,0 +1,76 @@
+"""
+Pure-Python version of closestpair.pyx, used when the extension module
+hasn't been compiled.
+"""
+
+
+def distance(x1, y1, x2, y2):
+    "Pythagorean distance"
+    return ((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5
+
+
+def closest_pair(points):
+    """
+    Returns the closest pair of points as
+    (distance, (x, y, data), (x2, y2, data2)).
+
+    @param points: A list of triples (x, y, data)
+    """
+    if len(points) < 2:
+        raise ValueError("Single or empty points set")
+    elif 2 <= len(points) <= 6:
+        min_d = float('inf')
+        min_p1 = None
+        min_p2 = None
+        for i, point in enumerate(points):
+            for point2 in points[i + 1:]:
+                d = distance(point[0], point[1], point2[0], point2[1])
+                if d < min_d:
+                    min_d = d
+                    min_p1 = point
+                    min_p2 = point2
+        return min_d, min_p1, min_p2
+    else:
+        points.sort(key=lambda p: (p[0], p[1]))
+        split = int(len(points) / 2)
+        d1, p11, p12 = closest_pair(points[:split])
+        d2, p21, p22 = closest_pair(points[split:])
+        d = min(d1, d2)
+        points_in_strip = []
+        split_at = (points[split - 1][0] + points[split][0]) / 2.0
+        for point in points:
+            if point[0] < (split_at - d):
+                continue
+            elif point[0] > (split_at + d):
+                break
+            points_in_strip.append((point[1], point[0], point[2]))
+        points_in_strip.sort(key=lambda p: (p[0], p[1]))
+        # Pairs across the split only count when closer than within a half
+        min_d = d
+        min_p1 = None
+        min_p2 = None
+        max_i = len(points_in_strip)
+        for (i, point) in enumerate(points_in_strip):
+            for point2 in points_in_strip[i + 1:min(max_i, i + 7)]:
+                sd = distance(point[0], point[1], point2[0], point2[1])
+                if sd < min_d:
+                    min_d = sd
+                    min_p1 = (point[1], point[0], point[2])
+                    min_p2 = (point2[1], point2[0], point2[2])
+        if min_p1 is not None:
+            return min_d, min_p1, min_p2
+        elif d1 < d2:
+            return d1, p11, p12
+        else:
+            return d2, p21, p22
+
+
+def closest_indices(xs, ys, index=None):
+    """
+    Returns the closest pair of points as (distance, i, j), where i and j
+    are positions in the xs and ys sequences.
+    """
+    if index is None:
+        index = range(len(xs))
+    d, p1, p2 = closest_pair([(xs[i], ys[i], i) for i in index])
+    return d, p1[2], p2[2]
@@ -1,6 +1,15 @@
-from random import uniform
+"""
+Synthetic inputs for ClusterLizard. The *_population functions yield
+reproducible (mx, my, id) tuples; random() and geonames() write CSV files.
+"""
+from bisect import bisect
+from random import Random, uniform
 import math
 
+# Spherical mercator x and (cropped) y extents
+ORIGIN = 20037508.34
+Y_EXTENT = 15037508.34
+
 
 def latlong_to_mercator(lat, long):
     x = long * 20037508.34 / 180
@@ -42,4 +51,60 @@ def geonames(file):
 
     f.close()
 
-geonames(open("cities15000.txt"))
+
+def uniform_population(n, seed=0):
+    "n people spread evenly over the map."
+    rand = Random(seed)
+    for i in xrange(n):
+        yield (rand.uniform(-ORIGIN, ORIGIN),
+               rand.uniform(-Y_EXTENT, Y_EXTENT), i)
+
+
+def city_population(n, seed=0):
+    """
+    n people around n / 100 cities whose sizes follow Zipf's law, most of
+    them within ten kilometres or so of the city centre.
+    """
+    rand = Random(seed)
+    centres = [(rand.uniform(-55, 70), rand.uniform(-180, 180))
+               for i in range(max(1, n // 100))]
+    totals = []
+    total = 0
+    for rank in range(len(centres)):
+        total += 1. / (rank + 1)
+        totals.append(total)
+    for i in xrange(n):
+        lat, long = centres[bisect(totals, rand.uniform(0, total))
+                            if len(centres) > 1 else 0]
+        lat = max(-85, min(85, lat + rand.gauss(0, 0.1)))
+        long = max(-180, min(180, long + rand.gauss(0, 0.1)))
+        x, y = latlong_to_mercator(lat, long)
+        yield (x, y, i)
+
+
+def dense_population(n, seed=0):
+    """
+    n people piled onto five spots, half of them on exactly the same
+    coordinates and the rest within a metre or so: the worst case for
+    nearest-neighbour searches, and a lot of distance ties.
+    """
+    rand = Random(seed)
+    spots = [latlong_to_mercator(lat, long) for lat, long in
+             [(51.5, -0.1), (48.85, 2.35), (40.71, -74), (35.7, 139.7),
+              (-33.87, 151.2)]]
+    for i in xrange(n):
+        x, y = spots[i % len(spots)]
+        if i % 2:
+            x, y = x + rand.gauss(0, 1), y + rand.gauss(0, 1)
+        yield (x, y, i)
+
+
+POPULATIONS = {
+    'uniform': uniform_population,
+    'cities': city_population,
+    'dense': dense_population,
+}
+
+
+if __name__ == '__main__':
+    geonames(open("cities15000.txt"))
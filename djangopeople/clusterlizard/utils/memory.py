@@ -0,0 +1,59 @@
+"""
+Compares the memory used by Cluster and CompactCluster on a synthetic
+input. Run with `python -m djangopeople.clusterlizard.utils.memory [n]`.
+"""
+import sys
+from random import Random
+
+from ..clusterer import Cluster, CompactCluster
+
+
+def sizeof(obj, seen=None):
+    "Recursive sys.getsizeof, counting shared objects once."
+    if seen is None:
+        seen = set()
+    if obj is None or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(sizeof(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, seen)
+        size += sum(sizeof(v, seen) for v in obj.__dict__.values())
+    for slot in getattr(type(obj), '__slots__', ()):
+        size += sizeof(getattr(obj, slot, None), seen)
+    return size
+
+
+def synthetic(n, seed=0):
+    rand = Random(seed)
+    for i in range(n):
+        yield (rand.uniform(-20037508.34, 20037508.34),
+               rand.uniform(-15037508.34, 15037508.34), i)
+
+
+def measure(cluster_class, n, group=10):
+    """
+    Returns the bytes per cluster for n singletons, and for the same points
+    merged into clusters of 'group' members.
+    """
+    singletons = [cluster_class.from_point(*p) for p in synthetic(n)]
+    single = sizeof(singletons) - sys.getsizeof(singletons)
+    merged = []
+    for i in range(0, n, group):
+        cluster = singletons[i]
+        for other in singletons[i + 1:i + group]:
+            cluster = cluster.merge(other)
+        merged.append(cluster)
+    grouped = sizeof(merged) - sys.getsizeof(merged)
+    return single / float(n), grouped / float(len(merged))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for cluster_class in (Cluster, CompactCluster):
+        single, grouped = measure(cluster_class, n)
+        print "%s: %i bytes/singleton, %i bytes/10-point cluster" % (
+            cluster_class.__name__, single, grouped,
+        )
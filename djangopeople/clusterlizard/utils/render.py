@@ -1,36 +1,97 @@
-
-import cairo
-import sys
-import os
+"""
+Renders clusters as circles on 256px PNG map tiles, with cairo. Run with
+`python -m djangopeople.clusterlizard.utils.render points.csv` to draw a
+CSV of mx,my,label rows onto a single world image, output.png.
+"""
+import errno
 import math
+import os
+import sys
+from cStringIO import StringIO
 
-width, height = 600.0, 600.0
-mx1, my1, mx2, my2 = [-20037508.34, 20037508.34, 20037508.34, -20037508.34]
-mxr = mx2 - mx1
-myr = my2 - my1
+try:
+    import cairo
+except ImportError:
+    cairo = None
 
-surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-context = cairo.Context(surface)
+ORIGIN = 20037508.34
+TILE_SIZE = 256
+# Biggest circle radius in pixels: clusters closer than that to the edge
+# of a tile get drawn on its neighbour too.
+MAX_RADIUS = 16
 
 
-def m_to_px(x, y):
-    return ((x - mx1) / mxr) * width, ((y - my1) / myr) * height
+def radius(number):
+    "Returns the radius, in pixels, of the circle of a 'number' cluster."
+    return min(MAX_RADIUS, 3 + 2 * math.log(number, 2))
 
-context.set_source_rgba(1, 1, 1, 1)
-context.paint()
 
-for row in open(sys.argv[1]):
-    x, y, label = row.split(",")
-    px, py = m_to_px(float(x), float(y))
-    try:
-        r = int(label) / 100 + 1
-    except ValueError:
-        r = 2
-    context.arc(px, py, r, 0, math.pi * 2)
+def world_pixel(mx, my, zoom, size=TILE_SIZE):
+    "Returns the position of a mercator point on the whole map, in pixels."
+    scale = size * 2 ** zoom / (2 * ORIGIN)
+    return (mx + ORIGIN) * scale, (ORIGIN - my) * scale
+
+
+def touched_tiles(mx, my, number, zoom):
+    "Returns the (x, y) tiles the circle of a cluster gets drawn on."
+    px, py = world_pixel(mx, my, zoom)
+    r = radius(number)
+    last = 2 ** zoom - 1
+
+    def span(p):
+        return range(max(0, int(math.floor((p - r) / TILE_SIZE))),
+                     min(last, int(math.floor((p + r) / TILE_SIZE))) + 1)
+    return [(x, y) for x in span(px) for y in span(py)]
+
+
+def render_tile(clusters, zoom, x, y, size=TILE_SIZE):
+    """
+    Draws (mx, my, number) clusters on a transparent tile and returns it as
+    PNG data.
+    """
+    if cairo is None:
+        raise ImportError("Rendering tiles needs pycairo")
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+    context = cairo.Context(surface)
     context.set_source_rgba(0, 0.2, 0.6, 0.8)
-    context.fill()
+    for mx, my, number in clusters:
+        px, py = world_pixel(mx, my, zoom, size)
+        context.arc(px - x * size, py - y * size, radius(number),
+                    0, math.pi * 2)
+        context.fill()
+    out = StringIO()
+    surface.write_to_png(out)
+    surface.finish()
+    return out.getvalue()
+
+
+def write_tile(args):
+    """
+    Renders a tile to 'path'. Takes a single (path, clusters, zoom, x, y)
+    tuple so that it can be mapped over a multiprocessing pool.
+    """
+    path, clusters, zoom, x, y = args
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Readers never see a half-written tile
+    with open(path + '.tmp', 'wb') as f:
+        f.write(render_tile(clusters, zoom, x, y))
+    os.rename(path + '.tmp', path)
+    return path
+
 
-surface.write_to_png("output.png")
-surface.finish()
+if __name__ == '__main__':
+    clusters = []
+    for row in open(sys.argv[1]):
+        x, y, label = row.split(",")
+        try:
+            number = int(label)
+        except ValueError:
+            number = 1
+        clusters.append((float(x), float(y), number))
 
-os.system("display output.png")
+    with open("output.png", "wb") as f:
+        f.write(render_tile(clusters, 0, 0, 0, size=600))
@@ -0,0 +1,30 @@
+"""
+Times ParallelClusterer against its serial engine for a range of worker
+counts on a synthetic input. Run with
+`python -m djangopeople.clusterlizard.utils.speedup [n] [workers...]`.
+"""
+import sys
+import time
+
+from ..clusterer import CompactCluster
+from ..indexed import IndexedClusterer
+from ..parallel import ParallelClusterer
+from .memory import synthetic
+
+
+def timed(clusterer, n, **kwargs):
+    start = time.time()
+    clusterer(synthetic(n), lambda clusters, zoom: None,
+              cluster_class=CompactCluster, **kwargs).run()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    workers = [int(w) for w in sys.argv[2:]] or [1, 2, 4, 8]
+    serial = timed(IndexedClusterer, n)
+    print "serial: %.2fs" % serial
+    for count in workers:
+        took = timed(ParallelClusterer, n, engine=IndexedClusterer,
+                     workers=count)
+        print "%i workers: %.2fs (x%.2f)" % (count, took, serial / took)
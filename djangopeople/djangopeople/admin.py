@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Country, CountrySite, Region, DjangoPerson, PortfolioSite
+from .models import (ClusteredPoint, Country, CountrySite, Region,
+                     DjangoPerson, PortfolioSite)
 
 
 class CountryAdmin(admin.ModelAdmin):
@@ -16,15 +17,22 @@ class RegionAdmin(admin.ModelAdmin):
 
 
 class DjangoPersonAdmin(admin.ModelAdmin):
-    list_display = ('user', 'profile_views')
+    list_display = ('user', 'live_profile_views')
     raw_id_fields = ('user',)
 
 
 class PortfolioSiteAdmin(admin.ModelAdmin):
     pass
 
+
+class ClusteredPointAdmin(admin.ModelAdmin):
+    list_display = ('zoom', 'latitude', 'longitude', 'number')
+    ordering = ('zoom',)
+    raw_id_fields = ('djangoperson',)
+
 admin.site.register(Country, CountryAdmin)
 admin.site.register(CountrySite, CountrySiteAdmin)
 admin.site.register(Region, RegionAdmin)
 admin.site.register(DjangoPerson, DjangoPersonAdmin)
 admin.site.register(PortfolioSite, PortfolioSiteAdmin)
+admin.site.register(ClusteredPoint, ClusteredPointAdmin)
@@ -2,47 +2,42 @@ import json
 
 from django.conf import settings
 from django.contrib.sites.models import RequestSite
-from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         StreamingHttpResponse)
 from django.shortcuts import redirect
 from django.utils import timezone
 
+from . import ircnicks, nearest
 from .models import Country, DjangoPerson
-from ..machinetags.models import MachineTaggedItem
+
+KM_PER_MILE = 1.609344
+# Default and biggest page sizes of /api/nearby/
+NEARBY_PAGE_SIZE = 100
+NEARBY_MAX_PAGE_SIZE = 1000
+# Most people /api/nearby/?k= looks for
+NEARBY_MAX_K = 1000
+# Nicks looked up per query by irc_spotted_batch
+IRC_BATCH_SIZE = 300
 
 
 def irc_lookup(request, irc_nick):
-    try:
-        person = MachineTaggedItem.objects.get(
-            namespace='im',
-            predicate='django',
-            value=irc_nick,
-        ).content_object
-    except MachineTaggedItem.DoesNotExist:
+    person = ircnicks.lookup([irc_nick]).get(irc_nick)
+    if person is None:
         return HttpResponse('no match', content_type='text/plain')
     scheme = 'https' if request.is_secure() else 'http'
-    url = '%s://%s%s' % (scheme,
-                         RequestSite(request).domain,
-                         reverse('user_profile', args=[person.user.username]))
+    url = '%s://%s%s' % (scheme, RequestSite(request).domain, person['path'])
     return HttpResponse(
-        u'%s, %s, %s, %s' % (person, person.location_description,
-                             person.country, url),
+        u'%s, %s' % (person['description'], url),
         content_type='text/plain',
     )
 
 
 def irc_redirect(request, irc_nick):
-    try:
-        person = MachineTaggedItem.objects.get(
-            namespace='im',
-            predicate='django',
-            value=irc_nick,
-        ).content_object
-    except MachineTaggedItem.DoesNotExist:
+    person = ircnicks.lookup([irc_nick]).get(irc_nick)
+    if person is None:
         return HttpResponse('no match', content_type='text/plain')
     scheme = 'https' if request.is_secure() else 'http'
-    url = '%s://%s%s' % (scheme, RequestSite(request).domain,
-                         reverse('user_profile', args=[person.user.username]))
+    url = '%s://%s%s' % (scheme, RequestSite(request).domain, person['path'])
     return redirect(url)
 
 
@@ -50,25 +45,64 @@ def irc_spotted(request, irc_nick):
     if request.POST.get('sekrit', '') != settings.API_PASSWORD:
         return api_response('BAD_SEKRIT')
 
-    try:
-        person = MachineTaggedItem.objects.get(
-            namespace='im', predicate='django', value=irc_nick
-        ).content_object
-    except MachineTaggedItem.DoesNotExist:
+    person = ircnicks.lookup([irc_nick]).get(irc_nick)
+    if person is None:
         return api_response('NO_MATCH')
 
-    if not person.irc_tracking_allowed():
+    if not person['tracking_allowed']:
         return api_response('TRACKING_FORBIDDEN')
 
-    first_time_seen = not person.last_active_on_irc
+    # Without save(), nothing else needs to know about IRC activity
+    people = DjangoPerson.objects.filter(pk=person['pk'])
+    if people.filter(last_active_on_irc__isnull=False).update(
+            last_active_on_irc=timezone.now()):
+        return api_response('TRACKED')
+    people.update(last_active_on_irc=timezone.now())
+    return api_response('FIRST_TIME_SEEN')
 
-    person.last_active_on_irc = timezone.now()
-    person.save()
 
-    if first_time_seen:
-        return api_response('FIRST_TIME_SEEN')
-    else:
-        return api_response('TRACKED')
+def irc_spotted_batch(request):
+    """
+    irc_spotted for many nicks, passed as repeated 'nick' POST parameters.
+    Returns a JSON object of the status of each nick.
+    """
+    if request.POST.get('sekrit', '') != settings.API_PASSWORD:
+        return api_response('BAD_SEKRIT')
+
+    nicks = sorted(set(request.POST.getlist('nick')))
+    statuses = {}
+    now = timezone.now()
+    # Batches stay under SQLite's limit on query parameters
+    for start in range(0, len(nicks), IRC_BATCH_SIZE):
+        statuses.update(spot_nicks(nicks[start:start + IRC_BATCH_SIZE], now))
+    return HttpResponse(json.dumps(statuses),
+                        content_type='application/json')
+
+
+def spot_nicks(nicks, now):
+    "Marks people as active on IRC, returns the status of each nick."
+    people = ircnicks.lookup(nicks)
+    pks = set(person['pk'] for person in people.values()
+              if person['tracking_allowed'])
+    seen = {}
+    if pks:
+        seen = dict(DjangoPerson.objects.filter(pk__in=pks).values_list(
+            'pk', 'last_active_on_irc'))
+        DjangoPerson.objects.filter(pk__in=pks).update(
+            last_active_on_irc=now)
+
+    statuses = {}
+    for nick in nicks:
+        person = people.get(nick)
+        if person is None:
+            statuses[nick] = 'NO_MATCH'
+        elif not person['tracking_allowed']:
+            statuses[nick] = 'TRACKING_FORBIDDEN'
+        elif seen.get(person['pk']):
+            statuses[nick] = 'TRACKED'
+        else:
+            statuses[nick] = 'FIRST_TIME_SEEN'
+    return statuses
 
 
 def api_response(code):
@@ -82,3 +116,79 @@ def stats(request):
     }
     return HttpResponse(json.dumps(payload),
                         content_type='application/json')
+
+
+def nearby(request):
+    """
+    People near a point, nearest first, as JSON. Takes lat and lon, plus
+    either radius (in km) or k, the number of people to find. Pages through
+    the results with offset and limit.
+    """
+    try:
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['lon'])
+        radius = float(request.GET.get('radius', 0))
+        k = int(request.GET.get('k', 0))
+        offset = int(request.GET.get('offset', 0))
+        limit = int(request.GET.get('limit', NEARBY_PAGE_SIZE))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('lat and lon are required numbers',
+                                      content_type='text/plain')
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        return HttpResponseBadRequest('lat or lon out of range',
+                                      content_type='text/plain')
+    if (radius > 0) == (k > 0):
+        return HttpResponseBadRequest('Pass either radius or k',
+                                      content_type='text/plain')
+    if k > NEARBY_MAX_K:
+        return HttpResponseBadRequest('k is at most %s' % NEARBY_MAX_K,
+                                      content_type='text/plain')
+    if offset < 0 or not 0 < limit <= NEARBY_MAX_PAGE_SIZE:
+        return HttpResponseBadRequest(
+            'limit is between 1 and %s' % NEARBY_MAX_PAGE_SIZE,
+            content_type='text/plain')
+
+    people = DjangoPerson.objects.all()
+    if radius:
+        found = nearest.within(people, latitude, longitude,
+                               radius / KM_PER_MILE)
+    else:
+        found = nearest.closest(people, latitude, longitude, k, exact=False)
+
+    next_url = None
+    if offset + limit < len(found):
+        query = request.GET.copy()
+        query['offset'] = offset + limit
+        next_url = request.build_absolute_uri(
+            '%s?%s' % (request.path, query.urlencode()))
+    return StreamingHttpResponse(
+        nearby_json(request, found[offset:offset + limit], len(found),
+                    next_url),
+        content_type='application/json')
+
+
+def nearby_json(request, found, count, next_url):
+    "Yields the JSON of a page of /api/nearby/, a few people at a time."
+    yield '{"count": %s, "next": %s, "results": [' % (
+        count, json.dumps(next_url))
+    people = DjangoPerson.objects.select_related('user', 'country')
+    separator = ''
+    for start in range(0, len(found), NEARBY_PAGE_SIZE):
+        chunk = found[start:start + NEARBY_PAGE_SIZE]
+        by_pk = people.in_bulk([pk for miles, pk in chunk])
+        for miles, pk in chunk:
+            # Whoever was deleted since the lookup is left out
+            person = by_pk.get(pk)
+            if person is None:
+                continue
+            yield separator + json.dumps({
+                'username': person.user.username,
+                'name': unicode(person),
+                'url': request.build_absolute_uri(person.get_absolute_url()),
+                'latitude': person.latitude,
+                'longitude': person.longitude,
+                'country': person.country.iso_code,
+                'distance_km': round(miles * KM_PER_MILE, 2),
+            })
+            separator = ','
+    yield ']}'
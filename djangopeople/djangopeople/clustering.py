@@ -1,11 +1,49 @@
+import functools
+import hashlib
 import math
 import json
+import multiprocessing
+import os
+import struct
+import time
+from collections import defaultdict
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.db.models import Q
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+
+from . import utils
+from .models import (DjangoPerson, ClusteredPoint, ClusteredPointShadow,
+                     ClusterUpdate, incremental_clustering)
+from ..clusterlizard.clusterer import Clusterer, CompactCluster
+from ..clusterlizard.grid import GridClusterer, ORIGIN
+from ..clusterlizard.indexed import IndexedClusterer
+from ..clusterlizard.parallel import ParallelClusterer
+from ..clusterlizard.utils.render import touched_tiles, write_tile
+
+# Available clustering engines, selected with settings.CLUSTERING_ENGINE
+ENGINES = {
+    'closestpair': Clusterer,
+    'indexed': IndexedClusterer,
+    'grid': GridClusterer,
+}
+
+# People read from the database per query when feeding the clusterer
+INPUT_CHUNK_SIZE = 5000
 
-from .models import DjangoPerson, ClusteredPoint
-from ..clusterlizard.clusterer import Clusterer
+# Seconds the tile generation number is kept in the cache. Far longer than
+# a run takes; once it expires, tiles are just computed again.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
 
 
 def latlong_to_mercator(lat, long):
@@ -24,34 +62,374 @@ def mercator_to_latlong(x, y):
     return lat, lon
 
 
-def input_generator():
+def latlongs_to_mercator(lats, longs):
+    "latlong_to_mercator over NumPy arrays of latitudes and longitudes."
+    x = longs * 20037508.34 / 180
+    y = numpy.log(numpy.tan((90 + lats) * numpy.pi / 360)) / (numpy.pi / 180)
+    y = y * 20037508.34 / 180
+    return x, y
+
+
+def input_chunks(chunk_size=INPUT_CHUNK_SIZE):
+    """
+    Yields lists of (latitude, longitude, id) rows, 'chunk_size' people at a
+    time in primary key order. Each chunk is a separate keyset query, so
+    neither the database driver nor the ORM ever holds the whole table.
+    """
+    people = DjangoPerson.objects.order_by('pk').values_list(
+        'latitude', 'longitude', 'id')
+    last = 0
+    while True:
+        rows = list(people.filter(pk__gt=last)[:chunk_size].iterator())
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][2]
+
+
+def input_generator(chunk_size=INPUT_CHUNK_SIZE):
     """
     The input to ClusterLizard should be a generator that yields
     (mx,my,id) tuples. This function reads them from the DjangoPeople models.
     """
-    for person in DjangoPerson.objects.all():
-        mx, my = latlong_to_mercator(person.latitude, person.longitude)
-        yield (mx, my, person.id)
+    for rows in input_chunks(chunk_size):
+        if numpy is None:
+            for lat, long, id in rows:
+                mx, my = latlong_to_mercator(lat, long)
+                yield (mx, my, id)
+            continue
+        lats, longs, ids = zip(*rows)
+        xs, ys = latlongs_to_mercator(numpy.array(lats), numpy.array(longs))
+        for point in zip(xs.tolist(), ys.tolist(), ids):
+            yield point
 
 
-def save_clusters(clusters, zoom):
+def save_clusters(clusters, zoom, model=ClusteredPoint):
     """
     The output function provided to ClusterLizard should be a
     function that takes 'clusters', a set of clusters, and 'zoom',
     the integer Google zoom level.
     """
+    points = []
     for cluster in clusters:
         lat, long = mercator_to_latlong(*cluster.mean)
-        ClusteredPoint.objects.create(
+        points.append(model(
             latitude=lat,
             longitude=long,
             number=len(cluster),
             zoom=zoom,
-            djangoperson_id=(len(cluster) == 1 and
-                             list(cluster.points)[0][2] or None),
+            djangoperson_id=(len(cluster) == 1 and cluster.ids[0] or None),
+        ))
+    model.objects.bulk_create(points, batch_size=1000)
+
+
+def swap_tables():
+    """
+    Swaps the ClusteredPoint and ClusteredPointShadow tables, so that the
+    results of a full run go live at once.
+    """
+    live = ClusteredPoint._meta.db_table
+    shadow = ClusteredPointShadow._meta.db_table
+    renames = ((live, live + '_old'), (shadow, live), (live + '_old', shadow))
+    with transaction.atomic():
+        cursor = connection.cursor()
+        for old, new in renames:
+            cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+                connection.ops.quote_name(old),
+                connection.ops.quote_name(new),
+            ))
+
+
+def mercator_lookup(bounds):
+    """
+    Returns the lookup arguments selecting latitudes and longitudes inside
+    (x1, y1, x2, y2) mercator bounds. The box is slightly padded to make up
+    for rounding errors, so matches have to be checked for an exact fit.
+    """
+    x1, y1, x2, y2 = bounds
+    south, west = mercator_to_latlong(x1, y1)
+    north, east = mercator_to_latlong(x2, y2)
+    pad = 1e-6
+    return {
+        'latitude__gte': south - pad,
+        'latitude__lte': north + pad,
+        'longitude__gte': west - pad,
+        'longitude__lte': east + pad,
+    }
+
+
+def cell_lookup(grid, cell, zoom):
+    return mercator_lookup(grid.bounds(cell, zoom))
+
+
+def in_cell(grid, cell, zoom, lat, long):
+    return grid.cell(latlong_to_mercator(lat, long), zoom) == cell
+
+
+def update_cell(grid, cell, zoom):
+    """
+    Replaces the cluster of a grid cell. At the highest zoom level it is
+    built from the people in the cell, and at the other levels from the
+    (up to four) clusters of the zoom level above.
+    """
+    lookup = cell_lookup(grid, cell, zoom)
+    if zoom == 17:
+        people = DjangoPerson.objects.filter(**lookup)
+        members = [(lat, long, 1, pk) for lat, long, pk in
+                   people.values_list('latitude', 'longitude', 'id')]
+    else:
+        members = ClusteredPoint.objects.filter(
+            zoom=zoom + 1, **lookup
+        ).values_list('latitude', 'longitude', 'number', 'djangoperson_id')
+
+    count, sum_x, sum_y, single = 0, 0., 0., None
+    for lat, long, number, person_id in members:
+        if not in_cell(grid, cell, zoom, lat, long):
+            continue
+        x, y = latlong_to_mercator(lat, long)
+        single = person_id
+        count += number
+        sum_x += x * number
+        sum_y += y * number
+
+    stale = [
+        pk for pk, lat, long in ClusteredPoint.objects.filter(
+            zoom=zoom, **lookup
+        ).values_list('pk', 'latitude', 'longitude')
+        if in_cell(grid, cell, zoom, lat, long)
+    ]
+    if stale:
+        ClusteredPoint.objects.filter(pk__in=stale).delete()
+    if count:
+        lat, long = mercator_to_latlong(sum_x / count, sum_y / count)
+        ClusteredPoint.objects.create(
+            latitude=lat,
+            longitude=long,
+            number=count,
+            zoom=zoom,
+            djangoperson_id=single if count == 1 else None,
         )
 
 
+def update_cells(grid, locations):
+    """
+    Recomputes the grid cells containing some (latitude, longitude) pairs,
+    from the highest zoom level down. Returns the (zoom, cell) updated.
+    """
+    points = [latlong_to_mercator(*p) for p in locations]
+    cells = [(zoom, cell) for zoom in range(17, -1, -1)
+             for cell in set(grid.cell(p, zoom) for p in points)]
+    for zoom, cell in cells:
+        update_cell(grid, cell, zoom)
+    return cells
+
+
+def update_clusters(old, new):
+    """
+    Updates the clusters after someone joined (old is None), moved or left
+    (new is None). old and new are (latitude, longitude) pairs. Only the
+    grid cells containing them are recomputed, in a single transaction
+    which also logs them for replay_updates() if a full run is in progress.
+    """
+    grid = GridClusterer(None, None)
+    locations = [p for p in (old, new) if p is not None]
+    with transaction.atomic():
+        cells = update_cells(grid, locations)
+        if ClusterUpdate.objects.exists():
+            ClusterUpdate.objects.bulk_create([
+                ClusterUpdate(latitude=lat, longitude=long)
+                for lat, long in locations
+            ])
+    for zoom, cell in cells:
+        invalidate_tiles(zoom, grid.bounds(cell, zoom))
+
+
+def replay_updates(after):
+    """
+    Recomputes the cells of the incremental updates logged after the
+    'after' id, the row marking the start of a full run, and deletes the
+    log up to them. They were made to the clusters being served while the
+    run went on, and got lost when its tables were swapped in.
+    """
+    updates = list(ClusterUpdate.objects.filter(pk__gt=after).values_list(
+        'pk', 'latitude', 'longitude'))
+    if updates and incremental_clustering():
+        with transaction.atomic():
+            update_cells(GridClusterer(None, None),
+                         [(lat, long) for pk, lat, long in updates])
+    ClusterUpdate.objects.filter(
+        pk__lte=max([after] + [pk for pk, lat, long in updates])).delete()
+    return len(updates)
+
+
+def mercator_tile(mx, my, zoom):
+    "Returns the (x, y) slippy map tile containing a mercator point."
+    size = 2 * ORIGIN / 2 ** zoom
+    return (int(math.floor((mx + ORIGIN) / size)),
+            int(math.floor((ORIGIN - my) / size)))
+
+
+def tile_bounds(x, y, zoom):
+    "Returns the (x1, y1, x2, y2) mercator bounds of a slippy map tile."
+    size = 2 * ORIGIN / 2 ** zoom
+    return (x * size - ORIGIN, ORIGIN - (y + 1) * size,
+            (x + 1) * size - ORIGIN, ORIGIN - y * size)
+
+
+def row_tile(row, zoom):
+    "Returns the tile containing a row from cluster_rows()."
+    mx, my = latlong_to_mercator(row[1], row[0])
+    return mercator_tile(mx, my, zoom)
+
+
+def tile_generation(new=False):
+    """
+    Tiles are cached under a generation number which changes with every full
+    run, so that tiles from the previous run never get served again. Tiles
+    of older generations expire after CLUSTER_TILE_MAX_AGE.
+
+    The full run happens in another process, so a cache that isn't shared
+    keeps a single generation and its tiles only go stale until they expire.
+    """
+    if not utils.cache_is_shared():
+        return 0
+    generation = None if new else cache.get('cluster-tiles-generation')
+    if generation is None:
+        generation = int(time.time() * 1000)
+        cache.set('cluster-tiles-generation', generation,
+                  GENERATION_TIMEOUT)
+    return generation
+
+
+def tile_key(zoom, x, y, generation, format):
+    return 'cluster-tile:%s:%s:%s:%s:%s' % (generation, format, zoom, x, y)
+
+
+def make_tiles(rows):
+    "Returns the (etag, payload) pairs cached for a tile, by format."
+    tiles = {}
+    for format, (content_type, encode) in FORMATS.items():
+        payload = encode(rows)
+        tiles[format] = hashlib.md5(payload).hexdigest(), payload
+    return tiles
+
+
+def get_tile(zoom, x, y, format):
+    generation = tile_generation()
+    tile = cache.get(tile_key(zoom, x, y, generation, format))
+    if tile is None:
+        query = ClusteredPoint.objects.filter(
+            zoom=zoom, **mercator_lookup(tile_bounds(x, y, zoom))
+        ).order_by('pk')
+        tiles = make_tiles([row for row in cluster_rows(query)
+                            if row_tile(row, zoom) == (x, y)])
+        cache.set_many(dict(
+            (tile_key(zoom, x, y, generation, f), t) for f, t in tiles.items()
+        ), settings.CLUSTER_TILE_MAX_AGE)
+        tile = tiles[format]
+    return tile
+
+
+def precompute_tiles():
+    """
+    Caches every tile holding clusters, under a new generation. Pointless
+    unless the web processes share the cache.
+    """
+    if not utils.cache_is_shared():
+        return
+    generation = tile_generation(new=True)
+    for zoom in range(17, -1, -1):
+        tiles = defaultdict(list)
+        query = ClusteredPoint.objects.filter(zoom=zoom).order_by('pk')
+        for row in cluster_rows(query):
+            tiles[row_tile(row, zoom)].append(row)
+        for (x, y), rows in tiles.items():
+            cache.set_many(dict(
+                (tile_key(zoom, x, y, generation, format), tile)
+                for format, tile in make_tiles(rows).items()
+            ), settings.CLUSTER_TILE_MAX_AGE)
+
+
+def invalidate_tiles(zoom, bounds):
+    "Drops the cached tiles overlapping some mercator bounds."
+    x1, y1, x2, y2 = bounds
+    left, top = mercator_tile(x1, y2, zoom)
+    right, bottom = mercator_tile(x2, y1, zoom)
+    generation = tile_generation()
+    cache.delete_many([tile_key(zoom, x, y, generation, format)
+                       for x in range(left, right + 1)
+                       for y in range(top, bottom + 1)
+                       for format in FORMATS])
+
+
+def tile_image_path(zoom, x, y):
+    return os.path.join(settings.CLUSTER_TILE_DIR, str(zoom), str(x),
+                        '%s.png' % y)
+
+
+def render_tiles(max_zoom=None, workers=None, force=False):
+    """
+    Renders the clusters of zoom levels 0 to max_zoom as PNG tiles in
+    CLUSTER_TILE_DIR. A manifest keeps a digest of the clusters drawn on
+    each tile, so that only tiles whose clusters changed since the previous
+    call get rendered again, and tiles left without clusters get removed.
+    Returns the number of tiles rendered and removed.
+    """
+    if max_zoom is None:
+        max_zoom = settings.CLUSTER_TILE_RENDER_ZOOM
+    manifest_path = os.path.join(settings.CLUSTER_TILE_DIR, 'manifest.json')
+    manifest = {}
+    # Forcing re-renders every tile, but the tiles to remove are still
+    # found in the manifest
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    jobs = []
+    seen = set()
+    for zoom in range(max_zoom + 1):
+        tiles = defaultdict(list)
+        query = ClusteredPoint.objects.filter(zoom=zoom).values_list(
+            'latitude', 'longitude', 'number')
+        for lat, long, number in query.iterator():
+            mx, my = latlong_to_mercator(lat, long)
+            for tile in touched_tiles(mx, my, number, zoom):
+                tiles[tile].append((mx, my, number))
+        for (x, y), clusters in tiles.items():
+            key = '%s/%s/%s' % (zoom, x, y)
+            clusters.sort()
+            digest = hashlib.md5(repr(clusters)).hexdigest()
+            seen.add(key)
+            if force or manifest.get(key) != digest:
+                manifest[key] = digest
+                jobs.append((tile_image_path(zoom, x, y), clusters, zoom,
+                             x, y))
+
+    removed = [name for name in manifest if name not in seen]
+    for name in removed:
+        del manifest[name]
+        path = tile_image_path(*name.split('/'))
+        if os.path.exists(path):
+            os.remove(path)
+
+    jobs.append((os.path.join(settings.CLUSTER_TILE_DIR, 'blank.png'), [],
+                 0, 0, 0))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(write_tile, jobs, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(write_tile, jobs)
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(manifest_path + '.tmp', manifest_path)
+    return len(jobs) - 1, len(removed)
+
+
 def progress(done, left, took, zoom, eta):
     """
     You can also pass in an optional progress callback.
@@ -61,9 +439,55 @@ def progress(done, left, took, zoom, eta):
     )
 
 
-def as_json(request, x2, y1, x1, y2, z):
+def cluster_rows(query):
+    """
+    Returns the (longitude, latitude, number, username) of each cluster in a
+    ClusteredPoint queryset. Only single-person clusters have a username,
+    which is fetched in the same query.
+    """
+    return list(query.values_list('longitude', 'latitude', 'number',
+                                  'djangoperson__user__username'))
+
+
+def encode_json(rows):
+    """
+    A list of [longitude, latitude, number, url], url linking to the
+    profile of single-person clusters.
+    """
+    return json.dumps([
+        (long, lat, number,
+         username and reverse('user_profile', args=[username]))
+        for long, lat, number, username in rows
+    ])
+
+
+def encode_binary(rows):
+    """
+    A little-endian uint32 count of clusters, followed by an int32
+    longitude, int32 latitude (both in millionths of a degree) and uint32
+    number for each of them. Then come the UTF-8 usernames of the
+    single-person clusters in the same order, separated by newlines.
+    """
+    values = []
+    usernames = []
+    for long, lat, number, username in rows:
+        values.extend((int(round(long * 1e6)), int(round(lat * 1e6)), number))
+        if number == 1:
+            usernames.append(username or u'')
+    return (struct.pack('<I' + 'iiI' * len(rows), len(rows), *values) +
+            u'\n'.join(usernames).encode('utf-8'))
+
+
+FORMATS = {
+    'json': ('application/json', encode_json),
+    'bin': ('application/octet-stream', encode_binary),
+}
+
+
+def as_json(request, x2, y1, x1, y2, z, format='json'):
     """
-    View that returns clusters for the given zoom level as JSON.
+    View that returns clusters for the given zoom level, as JSON or in the
+    binary format.
     """
     x1, y1, x2, y2 = map(float, (x1, y1, x2, y2))
     if y1 > y2:
@@ -81,26 +505,79 @@ def as_json(request, x2, y1, x1, y2, z):
                                     latitude__lt=y2),
             zoom=z)
 
-    points = []
-    for cluster in query:
-        if cluster.djangoperson:
-            points.append((cluster.longitude, cluster.latitude,
-                           cluster.number,
-                           cluster.djangoperson.get_absolute_url()))
-        else:
-            points.append((cluster.longitude, cluster.latitude,
-                           cluster.number, None))
-    return HttpResponse(json.dumps(points))
+    content_type, encode = FORMATS[format]
+    return HttpResponse(encode(cluster_rows(query)),
+                        content_type=content_type)
 
 
-def run():
+def tile(request, z, x, y, format='json'):
     """
-    Runs the clustering, clearing the DB first.
+    View that returns the clusters of a slippy map tile, as JSON or in the
+    binary format.
+    """
+    zoom, x, y = int(z), int(x), int(y)
+    if zoom > 17 or x >= 2 ** zoom or y >= 2 ** zoom:
+        raise Http404
+    etag, payload = get_tile(zoom, x, y, format)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(payload, content_type=FORMATS[format][0])
+    response['ETag'] = quote_etag(etag)
+    patch_cache_control(response, public=True,
+                        max_age=settings.CLUSTER_TILE_MAX_AGE)
+    return response
+
+
+def tile_image(request, z, x, y):
     """
-    ClusteredPoint.objects.all().delete()
-    clusterer = Clusterer(
+    View that serves the PNG tiles written by render_tiles(). Tiles without
+    any cluster on them get a blank tile.
+    """
+    zoom, x, y = int(z), int(x), int(y)
+    if (zoom > settings.CLUSTER_TILE_RENDER_ZOOM or
+            x >= 2 ** zoom or y >= 2 ** zoom):
+        raise Http404
+    for path in (tile_image_path(zoom, x, y),
+                 os.path.join(settings.CLUSTER_TILE_DIR, 'blank.png')):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                response = HttpResponse(f.read(), content_type='image/png')
+            patch_cache_control(response, public=True,
+                                max_age=settings.CLUSTER_TILE_MAX_AGE)
+            return response
+    raise Http404
+
+
+def run(workers=None, stats=None):
+    """
+    Runs the clustering into the shadow table, and swaps it with the live
+    one when done. Incremental updates made in the meantime are replayed
+    on the new clusters. With more than one worker, the engine runs in a
+    pool of processes (see ParallelClusterer). 'stats', if given, is called
+    with a dict of aggregates (merges, timings, memory...) after each zoom
+    level.
+    """
+    if workers is None:
+        workers = settings.CLUSTERING_WORKERS
+    engine = ENGINES[settings.CLUSTERING_ENGINE]
+    kwargs = {'cluster_class': CompactCluster, 'stats': stats}
+    if workers > 1:
+        kwargs.update(engine=engine, workers=workers)
+        engine = ParallelClusterer
+
+    ClusteredPointShadow.objects.all().delete()
+    # Incremental updates from now on miss the shadow table. This row gets
+    # them logged until replay_updates() deletes it.
+    started = ClusterUpdate.objects.create(latitude=0, longitude=0).pk
+    clusterer = engine(
         input_generator(),
-        save_clusters,
+        functools.partial(save_clusters, model=ClusteredPointShadow),
         progress,
+        **kwargs
     )
     clusterer.run()
+    swap_tables()
+    replay_updates(started)
+    ClusteredPointShadow.objects.all().delete()
+    precompute_tiles()
@@ -0,0 +1,77 @@
+"""
+Write-behind profile view counter. Views are counted in the cache, which
+is cheap and doesn't lock rows, and `manage.py flush_profile_views` moves
+the pending counts to DjangoPerson.profile_views every now and then.
+Without a cache shared by every process, views are written right away.
+"""
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from . import utils
+from .models import DjangoPerson
+
+# Number of people whose pending views are read or written per query
+BATCH_SIZE = 500
+
+# Seconds pending views are kept, counted from someone's first view since the
+# last flush. Backends want a number, and flush_profile_views runs far more
+# often than this.
+TIMEOUT = 60 * 60 * 24 * 30
+
+
+def view_key(pk):
+    return 'profile-views:%s' % pk
+
+
+def increment(pk):
+    "Counts a view of someone's profile."
+    if not utils.cache_is_shared():
+        # flush_profile_views would never see this process' counts
+        DjangoPerson.objects.filter(pk=pk).update(
+            profile_views=F('profile_views') + 1)
+        return
+    key = view_key(pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Missing key. Someone else may have just added it.
+        if not cache.add(key, 1, TIMEOUT):
+            cache.incr(key)
+
+
+def pending(pks):
+    "Returns the views not flushed yet of some people, by pk."
+    keys = dict((view_key(pk), pk) for pk in pks)
+    return dict((keys[key], views)
+                for key, views in cache.get_many(keys.keys()).items())
+
+
+def flush():
+    """
+    Adds the pending views to DjangoPerson.profile_views, with one UPDATE per
+    distinct number of views. Returns the number of views flushed.
+    """
+    flushed = 0
+    pks = list(DjangoPerson.objects.values_list('pk', flat=True))
+    for start in range(0, len(pks), BATCH_SIZE):
+        found = dict((pk, views) for pk, views in pending(
+            pks[start:start + BATCH_SIZE]).items() if views)
+        by_views = defaultdict(list)
+        for pk, views in found.items():
+            by_views[views].append(pk)
+        with transaction.atomic():
+            for views, batch in by_views.items():
+                DjangoPerson.objects.filter(pk__in=batch).update(
+                    profile_views=F('profile_views') + views)
+        # Only once written. Views counted since they were read stay pending.
+        for pk, views in found.items():
+            try:
+                cache.decr(view_key(pk), views)
+            except ValueError:
+                # Evicted since it was read. The views were written anyway.
+                pass
+        flushed += sum(found.values())
+    return flushed
@@ -424,6 +424,8 @@ class FindingForm(forms.ModelForm):
             ):
                 value = self.cleaned_data[fieldname].strip()
                 self.instance.add_machinetag(namespace, predicate, value)
+            elif namespace == 'privacy':
+                self.instance.set_privacy(predicate, '')
 
 
 class PortfolioForm(forms.ModelForm):
@@ -0,0 +1,105 @@
+"""
+Geohashes: base 32 strings naming nested cells of the globe, alternately
+halving longitude and latitude with every bit. All the points in a cell
+share the cell's hash as a prefix, so a prefix lookup on an indexed column
+finds the people in a cell.
+"""
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DECODE = dict((c, i) for i, c in enumerate(BASE32))
+PRECISION = 12
+
+# Shortest distance covered by a degree of latitude, in miles
+MILES_PER_LAT_DEGREE = 68.7
+# Length of a degree of longitude at the equator, in miles
+MILES_PER_LONG_DEGREE = 69.17
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    "Returns the geohash of a point."
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            bounds, coord = long_range, longitude
+        else:
+            bounds, coord = lat_range, latitude
+        middle = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if coord >= middle:
+            value |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def decode(geohash):
+    """
+    Returns the (south, west, north, east) bounds of the cell of a geohash.
+    """
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    even = True
+    for c in geohash:
+        value = DECODE[c]
+        for shift in range(4, -1, -1):
+            bounds = long_range if even else lat_range
+            middle = (bounds[0] + bounds[1]) / 2
+            if value >> shift & 1:
+                bounds[0] = middle
+            else:
+                bounds[1] = middle
+            even = not even
+    return lat_range[0], long_range[0], lat_range[1], long_range[1]
+
+
+def cell_size(precision):
+    "Returns the (latitude, longitude) size in degrees of a cell."
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def neighbours(geohash):
+    """
+    Returns the hashes of the (up to) 9 cells made of 'geohash' and the
+    cells around it. Longitude wraps around, cells beyond the poles are
+    left out.
+    """
+    south, west, north, east = decode(geohash)
+    lat_size, long_size = north - south, east - west
+    lat, long = (south + north) / 2, (west + east) / 2
+    cells = []
+    for dlat in (-1, 0, 1):
+        neighbour_lat = lat + dlat * lat_size
+        if not -90 < neighbour_lat < 90:
+            continue
+        for dlong in (-1, 0, 1):
+            neighbour_long = (long + dlong * long_size + 180) % 360 - 180
+            cells.append(encode(neighbour_lat, neighbour_long,
+                                len(geohash)))
+    return sorted(set(cells))
+
+
+def search_radius(latitude, precision):
+    """
+    Returns a distance in miles such that everything closer than that to a
+    point at 'latitude' lies in the 9 cells of 'precision' around it.
+    """
+    lat_size, long_size = cell_size(precision)
+    # Cells get narrower towards the poles, use the far edge of the block
+    edge = min(90, abs(latitude) + 2 * lat_size)
+    return min(lat_size * MILES_PER_LAT_DEGREE,
+               long_size * MILES_PER_LONG_DEGREE *
+               math.cos(math.radians(edge)))
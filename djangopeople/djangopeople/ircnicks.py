@@ -0,0 +1,96 @@
+"""
+IRC nicks (im:django machine tags) resolved to what the IRC API needs,
+cached so that the bot's requests don't hit the database. Entries are
+dropped when a nick, its person or their user changes, and
+`manage.py warm_irc_nicks` fills the cache for everyone at once.
+Without a cache shared by every process, changes made in one process
+couldn't drop the entries of the others, so nothing gets cached.
+"""
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+
+from . import utils
+from .models import DjangoPerson
+
+# Entries are dropped on change, this only bounds staleness for changes
+# that don't send signals, like renaming a country.
+TIMEOUT = 60 * 60 * 24
+# Cached for nicks that don't belong to anyone
+NO_MATCH = ''
+
+
+def nick_key(nick):
+    return 'irc-nick:%s' % nick.encode('utf-8').encode('hex')
+
+
+def user_key(user_id):
+    "Remembers the nicks of a user, to drop them when the user changes."
+    return 'irc-nick-user:%s' % user_id
+
+
+def lookup(nicks):
+    """
+    Returns the people using some nicks, as dictionaries of the pk, the
+    profile path, the description given to IRC and whether they allow IRC
+    tracking. Nicks that don't belong to anyone are left out.
+    """
+    if not utils.cache_is_shared():
+        found = load(nicks)
+        return dict((nick, entry) for nick, entry in found.items() if entry)
+    keys = dict((nick_key(nick), nick) for nick in nicks)
+    found = dict((keys[key], entry)
+                 for key, entry in cache.get_many(keys.keys()).items())
+    missing = [nick for nick in nicks if nick not in found]
+    if missing:
+        found.update(load(missing))
+    return dict((nick, entry) for nick, entry in found.items() if entry)
+
+
+def load(nicks=None):
+    """
+    Resolves nicks, or all of them, with one query and caches the results
+    if the cache is shared.
+    """
+    # A single filter() so that every condition applies to the same tag
+    tag = {'machinetags__namespace': 'im', 'machinetags__predicate': 'django'}
+    if nicks is not None:
+        tag['machinetags__value__in'] = nicks
+    people = DjangoPerson.objects.filter(**tag)
+    found = dict((nick, NO_MATCH) for nick in nicks or ())
+    users = {}
+    for (nick, pk, user_id, username, first_name, last_name, location,
+         country, irctrack) in people.values_list(
+            'machinetags__value', 'pk', 'user_id', 'user__username',
+            'user__first_name', 'user__last_name', 'location_description',
+            'country__name', 'privacy_irctrack'):
+        name = (u'%s %s' % (first_name, last_name)).strip()
+        found[nick] = {
+            'pk': pk,
+            'path': reverse('user_profile', args=[username]),
+            'description': u'%s, %s, %s' % (name, location, country),
+            'tracking_allowed': irctrack != 'private',
+        }
+        users.setdefault(user_key(user_id), set()).add(nick)
+    if not utils.cache_is_shared():
+        return found
+    if nicks is not None:
+        # Keep the user's other nicks, cached by earlier lookups
+        for key, known in cache.get_many(users.keys()).items():
+            users[key].update(known)
+    cache.set_many(dict((nick_key(nick), entry)
+                        for nick, entry in found.items()), TIMEOUT)
+    cache.set_many(dict((key, sorted(user_nicks))
+                        for key, user_nicks in users.items()), TIMEOUT)
+    return found
+
+
+def forget(nick):
+    cache.delete(nick_key(nick))
+
+
+def forget_user(user_id):
+    "Drops the cached nicks of a user, if any."
+    nicks = cache.get(user_key(user_id))
+    if nicks is not None:
+        cache.delete_many([nick_key(nick) for nick in nicks] +
+                          [user_key(user_id)])
@@ -0,0 +1,163 @@
+import json
+import multiprocessing
+import os
+import platform
+import Queue
+import signal
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...clustering import ENGINES
+from ....clusterlizard import clusterer, pyclosestpair
+from ....clusterlizard.clusterer import CompactCluster, peak_rss
+from ....clusterlizard.parallel import ParallelClusterer
+from ....clusterlizard.utils.generate import POPULATIONS
+
+CLOSEST_PAIR = {
+    'closest_pair': clusterer.closest_pair,
+    'pyclosestpair': pyclosestpair.closest_pair,
+}
+
+# Engines that are quadratic or worse only run up to that many points
+LIMITS = {
+    'closestpair': 5000,
+}
+
+
+def run_engine(name, points, workers):
+    counts = {}
+
+    def output(clusters, zoom):
+        counts[zoom] = len(clusters)
+
+    kwargs = {'cluster_class': CompactCluster}
+    if name == 'parallel':
+        engine = ParallelClusterer
+        kwargs.update(engine=ENGINES['indexed'], workers=workers)
+    else:
+        engine = ENGINES[name]
+    instance = engine(iter(points), output, **kwargs)
+    start = time.time()
+    instance.run()
+    took = time.time() - start
+    return {
+        'seconds': took,
+        'merges': instance.merges,
+        'merges_per_second': instance.merges / took if took else None,
+        'clusters_per_zoom': [counts[zoom] for zoom in range(18)],
+    }
+
+
+def run_closest_pair(name, points):
+    start = time.time()
+    d = CLOSEST_PAIR[name]([(x, y, id) for x, y, id in points])[0]
+    return {'seconds': time.time() - start, 'distance': d}
+
+
+def measure(queue, engine, population, size, seed, workers):
+    """
+    Runs in a fresh process so that the peak RSS only accounts for one
+    population and one engine. The process leads its own group, so that
+    a run that times out can be killed along with its pool workers.
+    """
+    os.setpgrp()
+    points = list(POPULATIONS[population](size, seed))
+    if engine in CLOSEST_PAIR:
+        result = run_closest_pair(engine, points)
+    else:
+        result = run_engine(engine, points, workers)
+    result['peak_rss_mb'] = peak_rss()
+    queue.put(result)
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the clustering engines and closest-pair "
+            "implementations on synthetic populations")
+    option_list = BaseCommand.option_list + (
+        make_option('--populations', default=','.join(sorted(POPULATIONS)),
+                    help='Comma-separated populations to generate'),
+        make_option('--sizes', default='1000,10000,100000,1000000',
+                    help='Comma-separated population sizes'),
+        make_option('--engines',
+                    default=','.join(sorted(ENGINES) + ['parallel'] +
+                                     sorted(CLOSEST_PAIR)),
+                    help='Comma-separated engines and closest-pair '
+                         'implementations to run'),
+        make_option('--seed', type='int', default=0),
+        make_option('--workers', type='int', default=None,
+                    help='Worker processes for the parallel engine'),
+        make_option('--timeout', type='int', default=600,
+                    help='Seconds after which a run is abandoned'),
+        make_option('--output', default='clustering-benchmark.json',
+                    help='JSON file to write the results to'),
+    )
+
+    def handle(self, **options):
+        populations = options['populations'].split(',')
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        engines = options['engines'].split(',')
+        for name in populations:
+            if name not in POPULATIONS:
+                raise CommandError("Unknown population: %s" % name)
+        for name in engines:
+            if name not in ENGINES and name not in CLOSEST_PAIR and (
+                    name != 'parallel'):
+                raise CommandError("Unknown engine: %s" % name)
+
+        results = []
+        self.stdout.write('population    size engine          seconds  '
+                          'merges/s  peak MB')
+        for population in populations:
+            for size in sizes:
+                for engine in engines:
+                    result = {'population': population, 'size': size,
+                              'engine': engine}
+                    if size > LIMITS.get(engine, size):
+                        result['skipped'] = True
+                    else:
+                        result.update(self.measure(engine, population, size,
+                                                   options))
+                    results.append(result)
+                    self.report(result)
+
+        with open(options['output'], 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'closest_pair': clusterer.closest_pair.__module__,
+                'seed': options['seed'],
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        self.stdout.write('Results written to %s' % options['output'])
+
+    def measure(self, engine, population, size, options):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(
+            queue, engine, population, size, options['seed'],
+            options['workers'],
+        ))
+        process.start()
+        try:
+            result = queue.get(timeout=options['timeout'])
+        except Queue.Empty:
+            os.killpg(process.pid, signal.SIGTERM)
+            result = {'timed_out': options['timeout']}
+        process.join()
+        return result
+
+    def report(self, result):
+        line = '%-10s %7s %-14s' % (result['population'], result['size'],
+                                    result['engine'])
+        if result.get('skipped'):
+            line += '  skipped'
+        elif result.get('timed_out'):
+            line += '  timed out after %ss' % result['timed_out']
+        else:
+            line += ' %8.2f %9s %8.0f' % (
+                result['seconds'],
+                '%.0f' % result['merges_per_second']
+                if result.get('merges_per_second') else '-',
+                result['peak_rss_mb'],
+            )
+        self.stdout.write(line)
@@ -0,0 +1,59 @@
+import time
+from optparse import make_option
+from random import Random
+
+from geopy import distance
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import nearest
+
+
+def vincenty_all(latitude, longitude, rows, num):
+    "The old path: a Vincenty distance for every candidate."
+    return sorted((distance.VincentyDistance(
+        (latitude, longitude), (lat, long)).miles, pk)
+        for pk, lat, long in rows)[:num]
+
+
+class Command(BaseCommand):
+    help = ("Compares computing Vincenty distances for every candidate "
+            "with the haversine pre-filter used by get_nearest")
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='100,10000,100000',
+                    help='Comma-separated numbers of candidates'),
+        make_option('--num', type='int', default=7,
+                    help='Number of nearest people to find'),
+        make_option('--seed', type='int', default=0),
+    )
+
+    def handle(self, **options):
+        rand = Random(options['seed'])
+        num = options['num']
+        self.stdout.write('candidates   vincenty  haversine+numpy  '
+                          'haversine+python   (ms)')
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            # Candidates in and around France
+            rows = [(i, rand.uniform(42, 51), rand.uniform(-5, 8))
+                    for i in range(size)]
+            latitude, longitude = rand.uniform(42, 51), rand.uniform(-5, 8)
+
+            timings = []
+            results = []
+            numpy = nearest.numpy
+            try:
+                for run, use_numpy in ((vincenty_all, True),
+                                       (nearest.nearest, True),
+                                       (nearest.nearest, False)):
+                    nearest.numpy = numpy if use_numpy else None
+                    start = time.time()
+                    results.append(run(latitude, longitude, rows, num))
+                    timings.append((time.time() - start) * 1000)
+            finally:
+                nearest.numpy = numpy
+            if numpy is None:
+                timings[1] = float('nan')
+            if not results[0] == results[1] == results[2]:
+                raise CommandError("The pre-filter changed the results")
+            self.stdout.write('%10s %10.1f %16.1f %17.1f' % (
+                (size,) + tuple(timings)))
@@ -0,0 +1,62 @@
+import gzip
+import time
+from cStringIO import StringIO
+from optparse import make_option
+from random import Random
+
+from django.core.management.base import BaseCommand
+
+from ...clustering import FORMATS, latlong_to_mercator, mercator_to_latlong
+from ....clusterlizard.clusterer import CompactCluster
+from ....clusterlizard.grid import GridClusterer
+
+
+def gzipped_size(payload):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(payload)
+    f.close()
+    return len(out.getvalue())
+
+
+class Command(BaseCommand):
+    help = ("Compares the size and encoding time of the cluster payload "
+            "formats on a synthetic population")
+    option_list = BaseCommand.option_list + (
+        make_option('--points', type='int', default=100000,
+                    help='Number of people to generate'),
+        make_option('--seed', type='int', default=0),
+    )
+
+    def handle(self, **options):
+        rand = Random(options['seed'])
+        points = []
+        for i in range(options['points']):
+            x, y = latlong_to_mercator(rand.uniform(-60, 70),
+                                       rand.uniform(-180, 180))
+            points.append((x, y, i))
+
+        rows = {}
+
+        def output(clusters, zoom):
+            rows[zoom] = []
+            for cluster in clusters:
+                lat, long = mercator_to_latlong(*cluster.mean)
+                username = None
+                if len(cluster) == 1:
+                    username = u'person%s' % cluster.ids[0]
+                rows[zoom].append((long, lat, len(cluster), username))
+        GridClusterer(iter(points), output,
+                      cluster_class=CompactCluster).run()
+
+        self.stdout.write('zoom clusters format    bytes  gzipped   ms')
+        for zoom in sorted(rows):
+            for format in sorted(FORMATS):
+                encode = FORMATS[format][1]
+                start = time.time()
+                payload = encode(rows[zoom])
+                took = (time.time() - start) * 1000
+                self.stdout.write('%4s %8s %6s %8s %8s %4.0f' % (
+                    zoom, len(rows[zoom]), format, len(payload),
+                    gzipped_size(payload), took,
+                ))
@@ -1,6 +1,27 @@
+from collections import defaultdict
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count
+
+from ...models import Country, DjangoPerson, Region
 
-from ...models import Country, Region
+# Most primary keys per UPDATE, below SQLite's limit on parameters
+BATCH_SIZE = 500
+
+
+def drift(model, field):
+    """
+    Returns (pk, stored, actual) for the countries or regions whose count of
+    people is wrong, with one query for the counts and one for the rows.
+    """
+    people = DjangoPerson.objects.filter(**{'%s__isnull' % field: False})
+    actual = dict(people.values_list(field).annotate(
+        Count('id')).order_by())
+    return [(pk, stored, actual.get(pk, 0))
+            for pk, stored in model.objects.values_list('pk', 'num_people')
+            if stored != actual.get(pk, 0)]
 
 
 class Command(NoArgsCommand):
@@ -8,9 +29,26 @@ class Command(NoArgsCommand):
     Countries and regions keep a denormalized count of people that gets out of
     sync during syncdb.  This updates it.
     """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Report wrong counts without fixing them'),
+    )
+
     def handle_noargs(self, **options):
-        for qs in (Country.objects.all(), Region.objects.all()):
-            for geo in qs:
-                qs.model.objects.filter(pk=geo.pk).update(
-                    num_people=geo.djangoperson_set.count(),
-                )
+        with transaction.atomic():
+            for model, field in ((Country, 'country'), (Region, 'region')):
+                wrong = drift(model, field)
+                for pk, stored, actual in wrong:
+                    self.stdout.write('%s %s: %s -> %s' % (
+                        model.__name__, pk, stored, actual))
+                if options['dry_run']:
+                    continue
+                # One UPDATE per distinct count, mostly 0 and 1
+                by_count = defaultdict(list)
+                for pk, stored, actual in wrong:
+                    by_count[actual].append(pk)
+                for count, pks in by_count.items():
+                    for start in range(0, len(pks), BATCH_SIZE):
+                        model.objects.filter(
+                            pk__in=pks[start:start + BATCH_SIZE],
+                        ).update(num_people=count)
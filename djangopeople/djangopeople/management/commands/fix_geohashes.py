@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from ... import geohash
+from ...models import DjangoPerson
+
+
+class Command(NoArgsCommand):
+    """
+    DjangoPerson.geohash is set when people are saved. This fills it in for
+    people saved before the column existed, or loaded from fixtures.
+    """
+    def handle_noargs(self, **options):
+        people = DjangoPerson.objects.values_list('id', 'latitude',
+                                                  'longitude', 'geohash')
+        with transaction.atomic():
+            for pk, latitude, longitude, current in people.iterator():
+                value = geohash.encode(latitude, longitude)
+                if value != current:
+                    DjangoPerson.objects.filter(pk=pk).update(geohash=value)
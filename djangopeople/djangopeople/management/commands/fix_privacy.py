@@ -0,0 +1,38 @@
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from ...models import DjangoPerson, PRIVACY_FIELDS
+from ....machinetags.models import MachineTaggedItem
+
+# Most primary keys per UPDATE, below SQLite's limit on parameters
+BATCH_SIZE = 500
+
+
+class Command(NoArgsCommand):
+    """
+    The privacy_* columns of DjangoPerson mirror the privacy machine tags.
+    This copies the tags to the columns, for people tagged before the
+    columns existed.
+    """
+    def handle_noargs(self, **options):
+        tags = MachineTaggedItem.objects.filter(
+            namespace='privacy',
+            content_type=ContentType.objects.get_for_model(DjangoPerson),
+        )
+        with transaction.atomic():
+            DjangoPerson.objects.update(**dict(
+                (field, '') for field in PRIVACY_FIELDS))
+            for field in PRIVACY_FIELDS:
+                predicate = field[len('privacy_'):]
+                by_value = defaultdict(list)
+                for pk, value in tags.filter(predicate=predicate).values_list(
+                        'object_id', 'value'):
+                    by_value[value].append(pk)
+                for value, pks in by_value.items():
+                    for start in range(0, len(pks), BATCH_SIZE):
+                        DjangoPerson.objects.filter(
+                            pk__in=pks[start:start + BATCH_SIZE],
+                        ).update(**{field: value})
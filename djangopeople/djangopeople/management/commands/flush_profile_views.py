@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+
+from ... import counters
+
+
+class Command(NoArgsCommand):
+    """
+    Profile views are counted in the cache. This adds them to the database,
+    and is meant to be run periodically.
+    """
+    def handle_noargs(self, **options):
+        flushed = counters.flush()
+        if int(options['verbosity']) > 1:
+            self.stdout.write('%s profile views flushed' % flushed)
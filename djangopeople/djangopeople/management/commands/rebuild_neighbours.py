@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from ... import neighbours
+
+
+class Command(NoArgsCommand):
+    """
+    Neighbours are refreshed when people join, move or leave. This builds
+    the whole table, for people saved before it existed or loaded from
+    fixtures.
+    """
+    def handle_noargs(self, **options):
+        neighbours.rebuild()
@@ -1,3 +1,8 @@
+import json
+import time
+from optparse import make_option
+
+from django.conf import settings
 from django.core.management.base import NoArgsCommand
 
 from ... import clustering
@@ -5,6 +10,27 @@ from ... import clustering
 
 class Command(NoArgsCommand):
     help = "Re-runs the server-side clustering"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=None,
+                    help='Number of worker processes (defaults to the '
+                         'CLUSTERING_WORKERS setting)'),
+        make_option('--stats', default=None, metavar='FILE',
+                    help='Append per-zoom statistics to FILE, as JSON lines'),
+    )
 
     def handle_noargs(self, **options):
-        clustering.run()
+        if not options['stats']:
+            clustering.run(workers=options['workers'])
+            return
+
+        run = {
+            'started': int(time.time()),
+            'engine': settings.CLUSTERING_ENGINE,
+            'workers': options['workers'] or settings.CLUSTERING_WORKERS,
+        }
+        with open(options['stats'], 'a') as f:
+            def stats(record):
+                record.update(run)
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+                f.flush()
+            clustering.run(workers=options['workers'], stats=stats)
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ... import clustering
+
+
+class Command(NoArgsCommand):
+    help = ("Renders the clusters of the low zoom levels as PNG tiles, "
+            "re-rendering only the tiles whose clusters changed")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--max-zoom', type='int', default=None,
+                    help='Highest zoom level to render (defaults to the '
+                         'CLUSTER_TILE_RENDER_ZOOM setting)'),
+        make_option('--workers', type='int', default=None,
+                    help='Number of rendering processes'),
+        make_option('--force', action='store_true', default=False,
+                    help='Render every tile, changed or not'),
+    )
+
+    def handle_noargs(self, **options):
+        rendered, removed = clustering.render_tiles(
+            options['max_zoom'], options['workers'], options['force'])
+        self.stdout.write("Rendered %s tiles, removed %s" % (
+            rendered, removed))
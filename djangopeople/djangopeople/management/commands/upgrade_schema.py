@@ -0,0 +1,129 @@
+import copy
+import re
+
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from ...models import DjangoPerson, PRIVACY_FIELDS
+from ....machinetags.models import MachineTaggedItem
+
+# Fields added to tables that already existed, which syncdb leaves alone
+COLUMNS = (
+    (DjangoPerson, 'geohash'),
+) + tuple((DjangoPerson, field) for field in PRIVACY_FIELDS)
+
+# Models whose index_together was added after their table
+INDEXES_TOGETHER = (MachineTaggedItem,)
+
+# Fields whose db_index was made redundant by an index_together
+OBSOLETE_INDEXES = (
+    (MachineTaggedItem, 'namespace'),
+    (MachineTaggedItem, 'predicate'),
+)
+
+
+def column_names(cursor, model):
+    return set(column.name for column in
+               connection.introspection.get_table_description(
+                   cursor, model._meta.db_table))
+
+
+def add_column(model, name):
+    """
+    Returns the SQL statements adding a field's column, and its indexes, to
+    an existing table. Existing rows get the field's default value.
+    """
+    field = model._meta.get_field(name)
+    qn = connection.ops.quote_name
+    default = field.get_default()
+    statements = ["ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT '%s'" % (
+        qn(model._meta.db_table), qn(field.column), field.db_type(connection),
+        default.replace("'", "''"))]
+    statements.extend(connection.creation.sql_indexes_for_field(
+        model, field, no_style()))
+    return statements
+
+
+def index_names(cursor, model):
+    "Returns the names of the indexes on a model's table."
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT indexname FROM pg_indexes '
+                       'WHERE tablename = %s', [table])
+        return set(row[0] for row in cursor.fetchall())
+    qn = connection.ops.quote_name
+    if connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % qn(table))
+        return set(row[2] for row in cursor.fetchall())
+    cursor.execute('PRAGMA index_list(%s)' % qn(table))
+    return set(row[1] for row in cursor.fetchall())
+
+
+def named(statements):
+    "Returns (index name, SQL) for some CREATE INDEX statements."
+    return [(re.match(r'CREATE INDEX (\S+) ON', sql).group(1).strip('"`'),
+             sql) for sql in statements]
+
+
+def create_indexes(model, names):
+    """
+    Returns (index name, SQL) for the statements creating an index on some
+    fields, as syncdb does for an index_together.
+    """
+    fields = [model._meta.get_field(name) for name in names]
+    return named(connection.creation.sql_indexes_for_fields(model, fields,
+                                                            no_style()))
+
+
+def field_indexes(model, name):
+    """
+    Returns (index name, SQL) for the statements syncdb ran when a field had
+    db_index=True. Backends name these differently from composite indexes,
+    and PostgreSQL adds a second one for LIKE queries.
+    """
+    field = copy.copy(model._meta.get_field(name))
+    field.db_index = True
+    return named(connection.creation.sql_indexes_for_field(model, field,
+                                                           no_style()))
+
+
+def drop_index(model, index):
+    sql = 'DROP INDEX %s' % connection.ops.quote_name(index)
+    if connection.vendor == 'mysql':
+        sql += ' ON %s' % connection.ops.quote_name(model._meta.db_table)
+    return sql
+
+
+class Command(NoArgsCommand):
+    """
+    syncdb only creates missing tables. This adds the columns and indexes
+    that were added to existing ones since, and drops the indexes that
+    aren't needed anymore, so it's safe to run on every deploy.
+    """
+    def handle_noargs(self, **options):
+        cursor = connection.cursor()
+        with transaction.atomic():
+            for model, name in COLUMNS:
+                if model._meta.get_field(name).column in column_names(
+                        cursor, model):
+                    continue
+                for sql in add_column(model, name):
+                    cursor.execute(sql)
+                self.stdout.write('Added %s.%s' % (model._meta.db_table,
+                                                   name))
+
+            for model in INDEXES_TOGETHER:
+                existing = index_names(cursor, model)
+                for names in model._meta.index_together:
+                    for index, sql in create_indexes(model, names):
+                        if index not in existing:
+                            cursor.execute(sql)
+                            self.stdout.write('Created index %s' % index)
+
+            for model, name in OBSOLETE_INDEXES:
+                existing = index_names(cursor, model)
+                for index, sql in field_indexes(model, name):
+                    if index in existing:
+                        cursor.execute(drop_index(model, index))
+                        self.stdout.write('Dropped index %s' % index)
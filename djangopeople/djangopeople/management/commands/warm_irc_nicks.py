@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+
+from ... import ircnicks, utils
+
+
+class Command(NoArgsCommand):
+    """
+    IRC nicks are cached as the IRC API looks them up. This caches all of
+    them with one query, after a deploy or a cache flush.
+    """
+    def handle_noargs(self, **options):
+        if not utils.cache_is_shared():
+            self.stdout.write("The cache isn't shared between processes, "
+                              "IRC nicks aren't cached")
+            return
+        ircnicks.load()
@@ -1,16 +1,20 @@
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 import tagging
 
-from geopy import distance
-
-from ..machinetags.models import MachineTaggedItem, add_machinetag
+from . import geohash, nearest
+from ..machinetags.models import (MachineTaggedItem, add_machinetag,
+                                  parse_machinetag)
 
 
 RESERVED_USERNAMES = set((
@@ -29,6 +33,9 @@ RESERVED_USERNAMES = set((
     'companies active'
 ).split())
 
+# Original value of a field that was deferred when its object was loaded
+DEFERRED = object()
+
 
 class CountryManager(models.Manager):
     def top_countries(self):
@@ -130,6 +137,9 @@ class DjangoPerson(models.Model):
     latitude = models.FloatField(_('Latitude'))
     longitude = models.FloatField(_('Longitude'))
     location_description = models.CharField(_('Location'), max_length=50)
+    # Spatial index for get_nearest(), kept in sync by save()
+    geohash = models.CharField(_('Geohash'), max_length=geohash.PRECISION,
+                               db_index=True, blank=True)
 
     # Profile photo -- FIXME remove when we have migrations, now using gravatar
     photo = models.FileField(blank=True, upload_to='profiles')
@@ -139,7 +149,17 @@ class DjangoPerson(models.Model):
 
     # Machine tags
     machinetags = generic.GenericRelation(MachineTaggedItem)
-    add_machinetag = add_machinetag
+
+    # Values of the privacy machine tags, '' when unset. Kept in sync by
+    # add_machinetag() and set_privacy().
+    privacy_search = models.CharField(_('Search visibility'), max_length=10,
+                                      blank=True)
+    privacy_email = models.CharField(_('Email privacy'), max_length=10,
+                                     blank=True)
+    privacy_im = models.CharField(_('IM privacy'), max_length=10,
+                                  blank=True)
+    privacy_irctrack = models.CharField(_('IRC tracking'), max_length=10,
+                                        blank=True, db_index=True)
 
     # OpenID delegation
     openid_server = models.URLField(_('OpenID server'), max_length=255,
@@ -151,6 +171,15 @@ class DjangoPerson(models.Model):
     last_active_on_irc = models.DateTimeField(_('Last active on IRC'),
                                               blank=True, null=True)
 
+    def __init__(self, *args, **kwargs):
+        super(DjangoPerson, self).__init__(*args, **kwargs)
+        # Location as loaded from the DB, for incremental clustering and
+        # neighbours. Deferred fields are left alone to avoid queries.
+        self._original_location = (self.__dict__.get('latitude'),
+                                   self.__dict__.get('longitude'))
+        self._original_country = self.__dict__.get('country_id', DEFERRED)
+        self._original_region = self.__dict__.get('region_id', DEFERRED)
+
     @property
     def latitude_str(self):
         return str(self.latitude)
@@ -166,30 +195,50 @@ class DjangoPerson(models.Model):
         except IndexError:
             return _('<none>')
 
+    def live_profile_views(self):
+        "Stored profile views, plus those not flushed from the cache yet."
+        from .counters import pending
+        return self.profile_views + pending([self.pk]).get(self.pk, 0)
+    live_profile_views.short_description = _('Profile views')
+
     def get_nearest(self, num=5):
         "Returns the nearest X people, but only within the same continent"
-        # TODO: Add caching
-
-        people = list(self.country.djangoperson_set.select_related().exclude(
-            pk=self.id,
-        ))
-        if len(people) <= num:
+        found = self.nearest_pks(num)
+        people = DjangoPerson.objects.select_related('user', 'country')
+        by_pk = people.in_bulk([pk for miles, pk in found])
+        for miles, pk in found:
+            by_pk[pk].distance_in_miles = int(miles)
+        return [by_pk[pk] for miles, pk in found]
+
+    def get_neighbours(self):
+        """
+        Same as get_nearest(), read from the NearestNeighbour table in one
+        query. Falls back to get_nearest() for people without any rows yet.
+        """
+        people = []
+        for row in self.neighbours.select_related('neighbour__user',
+                                                  'neighbour__country'):
+            row.neighbour.distance_in_miles = int(row.distance)
+            people.append(row.neighbour)
+        if not people:
+            from .neighbours import NUM_NEIGHBOURS
+            return self.get_nearest(NUM_NEIGHBOURS)
+        return people
+
+    def nearest_pks(self, num=5):
+        """
+        Returns (miles, pk) for the nearest X people from the same country,
+        or from the same continent if the country has too few people.
+        """
+        people = DjangoPerson.objects.exclude(pk=self.id)
+        if people.filter(country=self.country_id).count() > num:
+            people = people.filter(country=self.country_id)
+        else:
             # Not enough in country
             # use people from the same continent instead
-            people = list(DjangoPerson.objects.filter(
-                country__continent=self.country.continent,
-            ).exclude(pk=self.id).select_related())
-
-        # Sort and annotate people by distance
-        for person in people:
-            person.distance_in_miles = int(distance.VincentyDistance(
-                (self.latitude, self.longitude),
-                (person.latitude, person.longitude)
-            ).miles)
+            people = people.filter(country__continent=self.country.continent)
 
-        # Return the nearest X
-        people.sort(key=lambda x: x.distance_in_miles)
-        return people[:num]
+        return nearest.closest(people, self.latitude, self.longitude, num)
 
     def location_description_html(self):
         region = ''
@@ -213,25 +262,70 @@ class DjangoPerson(models.Model):
     def get_absolute_url(self):
         return reverse('user_profile', args=[self.user.username])
 
-    # TODO: Put in transaction
     def save(self, force_insert=False, force_update=False, **kwargs):
-        # Update country and region counters
-        super(DjangoPerson, self).save(force_insert=False, force_update=False,
-                                       **kwargs)
-        self.country.num_people = self.country.djangoperson_set.count()
-        self.country.save()
-        if self.region:
-            self.region.num_people = self.region.djangoperson_set.count()
-            self.region.save()
+        if self._state.adding:
+            old = old_country = old_region = None
+        else:
+            old = self._original_location
+            old_country = self._original_country
+            old_region = self._original_region
+        if old is not None and None in old:
+            # Loaded with deferred coordinates: the old grid cells are
+            # unknown and get fixed by the next full recluster.
+            old = None
+        self.geohash = geohash.encode(self.latitude, self.longitude)
+        with transaction.atomic():
+            super(DjangoPerson, self).save(force_insert=False,
+                                           force_update=False, **kwargs)
+            # Update country and region counters. Deferred ones can't be
+            # moved from, manage.py fix_counts takes care of them.
+            if old_country is not DEFERRED:
+                update_num_people(Country, old_country, self.country_id)
+            if old_region is not DEFERRED:
+                update_num_people(Region, old_region, self.region_id)
+        if old_country is DEFERRED:
+            old_country = None
+        # Outside of the transaction, so that the cached tiles aren't
+        # dropped before the new clusters are visible.
+        self.location_saved(old, old_country)
+        self._original_location = (self.latitude, self.longitude)
+        self._original_country = self.country_id
+        self._original_region = self.region_id
+
+    def location_saved(self, old, old_country):
+        "Updates clusters and neighbours after joining or moving."
+        from . import neighbours
+        new = (self.latitude, self.longitude)
+        if old != new and incremental_clustering():
+            from .clustering import update_clusters
+            update_clusters(old, new)
+        if old != new or old_country != self.country_id:
+            neighbours.refresh(neighbours.affected_by_save(self, old_country))
 
     class Meta:
         verbose_name = _('Django person')
         verbose_name_plural = _('Django people')
 
     def irc_tracking_allowed(self):
-        return not self.machinetags.filter(
-            namespace='privacy', predicate='irctrack', value='private',
-        ).count()
+        return self.privacy_irctrack != 'private'
+
+    def add_machinetag(self, *args):
+        namespace, predicate, value = parse_machinetag(*args)
+        add_machinetag(self, namespace, predicate, value)
+        if namespace == 'privacy':
+            self.set_privacy(predicate, value)
+
+    def set_privacy(self, predicate, value):
+        "Updates the column mirroring a privacy machine tag."
+        field = 'privacy_%s' % predicate
+        if field in PRIVACY_FIELDS and getattr(self, field) != value:
+            from . import ircnicks
+            setattr(self, field, value)
+            DjangoPerson.objects.filter(pk=self.pk).update(**{field: value})
+            ircnicks.forget_user(self.user_id)
+
+PRIVACY_FIELDS = ('privacy_search', 'privacy_email', 'privacy_im',
+                  'privacy_irctrack')
 
 tagging.register(DjangoPerson, tag_descriptor_attr='skilltags',
                  tagged_item_manager_attr='skilltagged')
@@ -264,24 +358,128 @@ class CountrySite(models.Model):
         verbose_name = _('Country site')
         verbose_name_plural = _('Country sites')
 
-#class ClusteredPoint(models.Model):
-#
-#    """
-#    Represents a clustered point on the map. Each cluster is at a lat/long,
-#    is only for one zoom level, and has a number of people.
-#    If it is only one person, it is also associated with a DjangoPerson ID.
-#    """
-#
-#    latitude = models.FloatField()
-#    longitude = models.FloatField()
-#    zoom = models.IntegerField()
-#    number = models.IntegerField()
-#    djangoperson = models.ForeignKey(DjangoPerson, blank=True, null=True)
-#
-#    def __unicode__(self):
-#        return "%s people at (%s,%s,z%s)" % (self.number, self.longitude,
-#                                             self.latitude, self.zoom)
-#
-#    class Admin:
-#        list_display = ("zoom", "latitude", "longitude", "number")
-#        ordering = ("zoom",)
+
+class NearestNeighbour(models.Model):
+    """
+    The precomputed nearest people of each person, with their distance in
+    miles and rank. See neighbours.py.
+    """
+    person = models.ForeignKey(DjangoPerson, related_name='neighbours')
+    neighbour = models.ForeignKey(DjangoPerson, related_name='+')
+    distance = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    def __unicode__(self):
+        return u"%s: #%s %s" % (self.person_id, self.rank, self.neighbour_id)
+
+    class Meta:
+        ordering = ('person', 'rank')
+        index_together = [('person', 'rank')]
+
+
+class ClusteredPointBase(models.Model):
+    """
+    Represents a clustered point on the map. Each cluster is at a lat/long,
+    is only for one zoom level, and has a number of people.
+    If it is only one person, it is also associated with a DjangoPerson ID.
+    """
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    zoom = models.IntegerField()
+    number = models.IntegerField()
+    djangoperson = models.ForeignKey(DjangoPerson, blank=True, null=True)
+
+    def __unicode__(self):
+        return u"%s people at (%s,%s,z%s)" % (self.number, self.longitude,
+                                              self.latitude, self.zoom)
+
+    class Meta:
+        abstract = True
+        index_together = [('zoom', 'latitude', 'longitude')]
+
+
+class ClusteredPoint(ClusteredPointBase):
+    "The clusters being served."
+
+
+class ClusteredPointShadow(ClusteredPointBase):
+    """
+    Where a full recluster writes its results before the table gets swapped
+    with ClusteredPoint's.
+    """
+
+
+class ClusterUpdate(models.Model):
+    """
+    A location whose grid cells were recomputed by an incremental update
+    while a full recluster runs, so that it can be replayed once the results
+    of the run go live. Each run starts by adding a row marking its start,
+    and updates are only logged while there are rows.
+    """
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+
+
+def incremental_clustering():
+    """
+    Whether clusters are updated whenever someone joins, moves or leaves.
+    Incremental updates recompute 'grid' cells, which would overwrite the
+    clusters of the other engines.
+    """
+    return (settings.CLUSTERING_INCREMENTAL and
+            settings.CLUSTERING_ENGINE == 'grid')
+
+
+def update_num_people(model, old_pk, new_pk):
+    "Moves someone from one Country or Region counter to another."
+    if old_pk == new_pk:
+        return
+    if old_pk is not None:
+        model.objects.filter(pk=old_pk).update(
+            num_people=F('num_people') - 1)
+    if new_pk is not None:
+        model.objects.filter(pk=new_pk).update(
+            num_people=F('num_people') + 1)
+
+
+@receiver(post_delete, sender=DjangoPerson)
+def counts_deleted(sender, instance, **kwargs):
+    update_num_people(Country, instance.country_id, None)
+    update_num_people(Region, instance.region_id, None)
+
+
+@receiver(pre_delete, sender=DjangoPerson)
+def location_deleting(sender, instance, **kwargs):
+    from . import neighbours
+    # Gathered before the deletion cascades to the neighbours table
+    instance._affected_neighbours = neighbours.affected_by_delete(instance)
+
+
+@receiver(post_delete, sender=DjangoPerson)
+def location_deleted(sender, instance, **kwargs):
+    from . import neighbours
+    neighbours.refresh(instance._affected_neighbours)
+    if incremental_clustering():
+        from .clustering import update_clusters
+        update_clusters((instance.latitude, instance.longitude), None)
+
+
+@receiver(post_save, sender=MachineTaggedItem)
+@receiver(post_delete, sender=MachineTaggedItem)
+def irc_nick_changed(sender, instance, **kwargs):
+    from . import ircnicks
+    if instance.namespace == 'im' and instance.predicate == 'django':
+        ircnicks.forget(instance.value)
+
+
+@receiver(post_save, sender=DjangoPerson)
+@receiver(post_delete, sender=DjangoPerson)
+def irc_person_changed(sender, instance, **kwargs):
+    from . import ircnicks
+    ircnicks.forget_user(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def irc_user_changed(sender, instance, **kwargs):
+    from . import ircnicks
+    ircnicks.forget_user(instance.pk)
@@ -0,0 +1,135 @@
+"""
+Two-stage distances for finding the people nearest to a point: a cheap
+great-circle distance ranks every candidate, then geopy's (much slower)
+Vincenty distance is only computed for those that can make the cut.
+Candidates are looked up in the geohash cells around the point.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from geopy import distance
+
+from django.db.models import Q
+
+from . import geohash
+
+# Mean radius of the Earth
+EARTH_RADIUS_MILES = 3958.76
+# Great-circle distances on a sphere are within about 0.6% of distances on
+# the ellipsoid Vincenty uses
+TOLERANCE = 1.01
+
+
+def haversine(latitude, longitude, lats, longs):
+    """
+    Returns the great-circle distances in miles from a point to each of the
+    points in lats and longs, as a list or a NumPy array.
+    """
+    if numpy is not None:
+        lat1, long1 = math.radians(latitude), math.radians(longitude)
+        lats = numpy.radians(numpy.asarray(lats, dtype=float))
+        longs = numpy.radians(numpy.asarray(longs, dtype=float))
+        a = (numpy.sin((lats - lat1) / 2) ** 2 + math.cos(lat1) *
+             numpy.cos(lats) * numpy.sin((longs - long1) / 2) ** 2)
+        return 2 * EARTH_RADIUS_MILES * numpy.arcsin(
+            numpy.sqrt(numpy.minimum(a, 1)))
+
+    lat1, long1 = math.radians(latitude), math.radians(longitude)
+    cos_lat1 = math.cos(lat1)
+    miles = []
+    for lat2, long2 in zip(lats, longs):
+        lat2, long2 = math.radians(lat2), math.radians(long2)
+        a = (math.sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * math.cos(lat2) *
+             math.sin((long2 - long1) / 2) ** 2)
+        miles.append(2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(min(a, 1))))
+    return miles
+
+
+def by_distance(latitude, longitude, rows):
+    """
+    Returns the great-circle distances from a point to (pk, latitude,
+    longitude) rows, as a list, and the indices of the rows, nearest first.
+    """
+    pks, lats, longs = zip(*rows)
+    approx = haversine(latitude, longitude, lats, longs)
+    if numpy is not None:
+        return (approx.tolist(),
+                numpy.argsort(approx, kind='mergesort').tolist())
+    return approx, sorted(range(len(rows)), key=approx.__getitem__)
+
+
+def nearest(latitude, longitude, rows, num, exact=True):
+    """
+    Returns (miles, pk) for the num rows nearest to a point, nearest first,
+    out of (pk, latitude, longitude) rows. Miles are Vincenty distances,
+    or great-circle distances if not 'exact'.
+    """
+    if not rows:
+        return []
+    pks, lats, longs = zip(*rows)
+    approx, order = by_distance(latitude, longitude, rows)
+    if not exact:
+        return [(approx[i], pks[i]) for i in order[:num]]
+
+    # Whatever is further than that can't be closer than the Xth candidate
+    cutoff = approx[order[min(num, len(rows)) - 1]] * TOLERANCE ** 2
+    exact = []
+    for i in order:
+        if approx[i] > cutoff:
+            break
+        exact.append((distance.VincentyDistance(
+            (latitude, longitude), (lats[i], longs[i])).miles, pks[i]))
+    exact.sort()
+    return exact[:num]
+
+
+def in_cells(people, latitude, longitude, precision):
+    "Filters a queryset down to the 9 cells of 'precision' around a point."
+    here = geohash.encode(latitude, longitude, precision)
+    return people.filter(reduce(
+        lambda q, cell: q | Q(geohash__startswith=cell),
+        geohash.neighbours(here), Q()))
+
+
+def closest(people, latitude, longitude, num, exact=True):
+    """
+    Returns (miles, pk) for the num people of a queryset nearest to a point,
+    nearest first.
+    """
+    # Look in the cells around the point, widening the cells until the Xth
+    # person found is closer than anyone outside them could be. Past the
+    # coarsest cells, fall back to everyone.
+    for precision in range(6, 1, -1) + [0]:
+        if precision:
+            candidates = in_cells(people, latitude, longitude, precision)
+        else:
+            candidates = people
+        found = nearest(
+            latitude, longitude,
+            list(candidates.values_list('id', 'latitude', 'longitude')),
+            num, exact,
+        )
+        if precision == 0 or (len(found) == num and found[-1][0] <
+                              geohash.search_radius(latitude, precision)):
+            return found
+
+
+def within(people, latitude, longitude, miles):
+    """
+    Returns (miles, pk) for the people of a queryset less than 'miles' away
+    from a point, nearest first. Distances are great-circle distances.
+    """
+    # The smallest cells that hold the whole circle
+    for precision in range(6, 0, -1):
+        if geohash.search_radius(latitude, precision) >= miles:
+            people = in_cells(people, latitude, longitude, precision)
+            break
+    rows = list(people.values_list('id', 'latitude', 'longitude'))
+    if not rows:
+        return []
+    approx, order = by_distance(latitude, longitude, rows)
+    return [(approx[i], rows[i][0]) for i in order if approx[i] <= miles]
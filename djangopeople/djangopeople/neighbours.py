@@ -0,0 +1,109 @@
+"""
+Nearest people are precomputed into the NearestNeighbour table, which is
+rebuilt in bulk by `manage.py rebuild_neighbours`. When someone joins,
+moves or leaves, only the people that could gain or lose them as a
+neighbour get their rows recomputed.
+"""
+from django.db import transaction
+
+from . import nearest
+from .models import DjangoPerson, NearestNeighbour
+
+# Number of neighbours shown on profile pages
+NUM_NEIGHBOURS = 7
+
+
+def neighbour_rows(person):
+    return [NearestNeighbour(person_id=person.pk, neighbour_id=pk,
+                             distance=miles, rank=rank)
+            for rank, (miles, pk) in enumerate(
+                person.nearest_pks(NUM_NEIGHBOURS), 1)]
+
+
+def refresh(pks):
+    "Recomputes the neighbours of some people."
+    if not pks:
+        return
+    with transaction.atomic():
+        NearestNeighbour.objects.filter(person__in=pks).delete()
+        rows = []
+        for person in DjangoPerson.objects.filter(
+                pk__in=pks).select_related('country'):
+            rows.extend(neighbour_rows(person))
+        NearestNeighbour.objects.bulk_create(rows, batch_size=1000)
+
+
+def rebuild():
+    "Recomputes everyone's neighbours."
+    with transaction.atomic():
+        NearestNeighbour.objects.all().delete()
+        rows = []
+        for person in DjangoPerson.objects.select_related(
+                'country').iterator():
+            rows.extend(neighbour_rows(person))
+            if len(rows) >= 1000:
+                NearestNeighbour.objects.bulk_create(rows)
+                rows = []
+        NearestNeighbour.objects.bulk_create(rows)
+
+
+def in_range(person):
+    """
+    Returns the people of the same continent that would have 'person' as a
+    neighbour: people closer to them than their furthest neighbour, and
+    people who don't have all their neighbours. People without any rows,
+    like everyone before the first rebuild(), are left alone: their profile
+    falls back to get_nearest().
+    """
+    same_continent = DjangoPerson.objects.filter(
+        country__continent=person.country.continent).exclude(pk=person.pk)
+    rows = list(NearestNeighbour.objects.filter(
+        rank=NUM_NEIGHBOURS,
+        person__in=same_continent,
+    ).values_list('person_id', 'distance', 'person__latitude',
+                  'person__longitude'))
+    pks = set(same_continent.filter(neighbours__isnull=False).exclude(
+        neighbours__rank=NUM_NEIGHBOURS).values_list('pk', flat=True))
+    if rows:
+        people, furthest, lats, longs = zip(*rows)
+        miles = nearest.haversine(person.latitude, person.longitude, lats,
+                                  longs)
+        pks.update(pk for pk, limit, d in zip(people, furthest, miles)
+                   if d <= limit * nearest.TOLERANCE)
+    return pks
+
+
+def country_changes(country_id):
+    """
+    Returns everyone in a country, if the country just got enough or too
+    few people to pick neighbours from it rather than from the continent.
+    """
+    people = DjangoPerson.objects.filter(country=country_id)
+    if people.count() in (NUM_NEIGHBOURS + 1, NUM_NEIGHBOURS + 2):
+        return set(people.values_list('pk', flat=True))
+    return set()
+
+
+def affected_by_save(person, old_country):
+    """
+    Returns the people whose neighbours may have changed after 'person'
+    joined, moved or changed countries.
+    """
+    pks = set([person.pk])
+    pks.update(NearestNeighbour.objects.filter(
+        neighbour=person).values_list('person_id', flat=True))
+    pks.update(in_range(person))
+    if old_country != person.country_id:
+        pks.update(country_changes(person.country_id))
+        if old_country is not None:
+            pks.update(country_changes(old_country))
+    return pks
+
+
+def affected_by_delete(person):
+    "Returns the people whose neighbours will change when 'person' leaves."
+    pks = set(NearestNeighbour.objects.filter(
+        neighbour=person).values_list('person_id', flat=True))
+    pks.update(country_changes(person.country_id))
+    pks.discard(person.pk)
+    return pks
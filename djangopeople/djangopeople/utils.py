@@ -1,5 +1,9 @@
 import datetime
 
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
 ORIGIN_DATE = datetime.date(2000, 1, 1)
 
 
@@ -26,3 +30,12 @@ def simple_decorator(decorator):
     new_decorator.__doc__ = decorator.__doc__
     new_decorator.__dict__.update(decorator.__dict__)
     return new_decorator
+
+
+def cache_is_shared():
+    """
+    Whether the default cache is seen by every process, like Redis or
+    memcached. Data that other processes rely on, or that they need to
+    invalidate, mustn't live in a local memory or dummy cache.
+    """
+    return not isinstance(cache, (LocMemCache, DummyCache))
@@ -10,7 +10,7 @@ from django.contrib import auth
 from django.core import signing
 from django.core.urlresolvers import reverse
 from django.db import transaction
-from django.db.models import Q, F
+from django.db.models import Q
 from django.http import Http404, HttpResponseForbidden, HttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.utils import timezone
@@ -22,7 +22,7 @@ from password_reset.views import Recover
 from tagging.models import Tag, TaggedItem
 from tagging.utils import calculate_cloud, get_tag
 
-from . import utils
+from . import counters, utils
 from .constants import (MACHINETAGS_FROM_FIELDS, IMPROVIDERS_DICT,
                         SERVICES_DICT)
 from .forms import (SkillsForm, SignupForm, PortfolioForm, BioForm,
@@ -31,7 +31,7 @@ from .forms import (SkillsForm, SignupForm, PortfolioForm, BioForm,
 from .models import DjangoPerson, Country, User, Region, PortfolioSite
 
 from ..machinetags.utils import tagdict
-from ..machinetags.models import MachineTaggedItem
+from ..machinetags.models import tagged_with
 
 NOTALPHA_RE = re.compile('[^a-zA-Z0-9]')
 
@@ -303,9 +303,7 @@ class ProfileView(generic.DetailView):
     def get_object(self):
         person = get_object_or_404(DjangoPerson,
                                    user__username=self.kwargs['username'])
-        DjangoPerson.objects.filter(pk=person.pk).update(
-            profile_views=F('profile_views') + 1,
-        )
+        counters.increment(person.pk)
         return person
 
     def get_context_data(self, **kwargs):
@@ -340,15 +338,15 @@ class ProfileView(generic.DetailView):
         # Set up vars that control privacy stuff
         privacy = {
             'show_im': (
-                mtags['privacy']['im'] == 'public' or
+                self.object.privacy_im == 'public' or
                 not self.request.user.is_anonymous()
             ),
             'show_email': (
-                mtags['privacy']['email'] == 'public' or
+                self.object.privacy_email == 'public' or
                 (not self.request.user.is_anonymous() and
-                 mtags['privacy']['email'] == 'private')
+                 self.object.privacy_email == 'private')
             ),
-            'hide_from_search': mtags['privacy']['search'] != 'public',
+            'hide_from_search': self.object.privacy_search != 'public',
             'show_last_irc_activity': bool(self.object.last_active_on_irc and
                                            self.object.irc_tracking_allowed()),
         }
@@ -365,7 +363,7 @@ class ProfileView(generic.DetailView):
             'services': services,
             'privacy': privacy,
             'show_finding': show_finding,
-            'people_list': self.object.get_nearest(num=7),
+            'people_list': self.object.get_neighbours(),
         })
         return context
 profile = ProfileView.as_view()
@@ -556,14 +554,10 @@ class CountryLookingForView(generic.ListView):
         self.country = get_object_or_404(
             Country, iso_code=self.kwargs['country_code'].upper(),
         )
-        ids = [
-            o['object_id'] for o in MachineTaggedItem.objects.filter(
-                namespace='profile',
-                predicate='looking_for_work',
-                value=self.kwargs['looking_for'],
-            ).values('object_id')
-        ]
-        return DjangoPerson.objects.filter(country=self.country, id__in=ids)
+        return tagged_with(
+            DjangoPerson.objects.filter(country=self.country),
+            'profile:looking_for_work=%s' % self.kwargs['looking_for'],
+        )
 
     def get_context_data(self, **kwargs):
         context = super(CountryLookingForView, self).get_context_data(**kwargs)
@@ -621,12 +615,10 @@ class IRCActiveView(generic.ListView):
     template_name = 'irc_active.html'
 
     def get_queryset(self):
-        results = DjangoPerson.objects.filter(
+        return DjangoPerson.objects.filter(
             last_active_on_irc__gt=(timezone.now() -
                                     datetime.timedelta(hours=1))
-        ).order_by('-last_active_on_irc')
-        # Filter out the people who don't want to be tracked (inefficient)
-        return [r for r in results if r.irc_tracking_allowed()]
+        ).exclude(privacy_irctrack='private').order_by('-last_active_on_irc')
 irc_active = IRCActiveView.as_view()
 
 
@@ -0,0 +1,103 @@
+import time
+from optparse import make_option
+from random import Random
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ...models import MachineTaggedItem, tags_matching
+
+NAMESPACES = {
+    'im': ['django', 'jabber', 'aim', 'msn', 'yahoo', 'gtalk'],
+    'services': ['flickr', 'twitter', 'github', 'delicious', 'linkedin'],
+    'privacy': ['search', 'email', 'im', 'irctrack'],
+    'profile': ['blog', 'looking_for_work'],
+}
+
+
+class Rollback(Exception):
+    "Raised to throw away the generated tags."
+
+
+class Command(BaseCommand):
+    help = ("Times machine tag lookups on a synthetic set of tags, inserted "
+            "in a transaction that gets rolled back")
+    option_list = BaseCommand.option_list + (
+        make_option('--tags', type='int', default=1000000,
+                    help='Number of tags to generate'),
+        make_option('--lookups', type='int', default=200,
+                    help='Number of lookups per query'),
+        make_option('--seed', type='int', default=0),
+    )
+
+    def handle(self, **options):
+        try:
+            with transaction.atomic():
+                self.benchmark(Random(options['seed']), options['tags'],
+                               options['lookups'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def benchmark(self, rand, num_tags, lookups):
+        content_type = ContentType.objects.get_for_model(MachineTaggedItem)
+        num_objects = max(1, num_tags // 10)
+        namespaces = sorted(NAMESPACES)
+        num_values = max(1, num_tags // 5)
+
+        start = time.time()
+        tags = []
+        for i in range(num_tags):
+            namespace = rand.choice(namespaces)
+            tags.append(MachineTaggedItem(
+                namespace=namespace,
+                predicate=rand.choice(NAMESPACES[namespace]),
+                value='value%s' % rand.randrange(num_values),
+                content_type=content_type,
+                object_id=rand.randrange(num_objects),
+            ))
+            if len(tags) == 10000:
+                MachineTaggedItem.objects.bulk_create(tags)
+                tags = []
+        MachineTaggedItem.objects.bulk_create(tags)
+        self.stdout.write('Inserted %s tags in %.1fs' % (
+            num_tags, time.time() - start))
+        if connection.vendor == 'sqlite':
+            # Index statistics, which other databases keep up to date
+            connection.cursor().execute('ANALYZE')
+
+        def value():
+            return 'value%s' % rand.randrange(num_values)
+
+        queries = [
+            ('im:django=<value>',
+             lambda: tags_matching('im:django=%s' % value())),
+            ('services:*=<value>',
+             lambda: tags_matching('services:*=%s' % value())),
+            ('*:*=<value>', lambda: tags_matching('*:*=%s' % value())),
+            ('im:django=<prefix>*',
+             lambda: tags_matching('im:django=%s*' % value()[:9])),
+            # As done by obj.machinetags.filter(namespace='privacy')
+            ('<object> privacy:*=*',
+             lambda: MachineTaggedItem.objects.filter(
+                 content_type=content_type,
+                 object_id=rand.randrange(num_objects),
+                 namespace='privacy')),
+        ]
+        self.stdout.write('%-32s %10s %8s' % ('query', 'ms/lookup', 'rows'))
+        for name, query in queries:
+            rows = 0
+            start = time.time()
+            for i in range(lookups):
+                rows += len(list(query().values_list('object_id')))
+            took = (time.time() - start) * 1000 / lookups
+            self.stdout.write('%-32s %10.3f %8.1f' % (
+                name, took, float(rows) / lookups))
+            if connection.vendor == 'sqlite':
+                sql, params = query().values_list(
+                    'object_id').query.sql_with_params()
+                cursor = connection.cursor()
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                for row in cursor.fetchall():
+                    self.stdout.write('    %s' % row[-1])
@@ -5,8 +5,11 @@ from django.contrib.contenttypes import generic
 
 class MachineTaggedItem(models.Model):
     "A machine tag on an item."
-    namespace = models.CharField(max_length=50, db_index=True)
-    predicate = models.CharField(max_length=50, db_index=True)
+    # Lookups by predicate always come with a namespace, and are covered by
+    # the composite indexes below. '*:*=value' patterns need an index
+    # starting with the value.
+    namespace = models.CharField(max_length=50)
+    predicate = models.CharField(max_length=50)
     value = models.CharField(max_length=255, db_index=True)
 
     content_type = models.ForeignKey(ContentType)
@@ -16,6 +19,12 @@ class MachineTaggedItem(models.Model):
 
     class Meta:
         ordering = ('namespace', 'predicate', 'value')
+        index_together = [
+            # Looking up tags, and what they're on
+            ('namespace', 'predicate', 'value'),
+            # Tags of an object: obj.machinetags.filter(...)
+            ('content_type', 'object_id', 'namespace', 'predicate'),
+        ]
 
     def __unicode__(self):
         value = self.value
@@ -26,6 +35,8 @@ class MachineTaggedItem(models.Model):
 import re
 _part_re = re.compile('^[a-z][a-z0-9_]*$')
 _machinetag_re = re.compile('^([a-z][a-z0-9_]*):([a-z][a-z0-9_]*)=(.*)$')
+_pattern_re = re.compile(r'^([a-z][a-z0-9_]*|\*):([a-z][a-z0-9_]*|\*)=(.*)$')
+WILDCARD = '*'
 
 
 def is_valid_part(part):
@@ -52,6 +63,55 @@ def parse_machinetag(namespace_or_fulltag, predicate=None, value=None):
     return namespace, predicate, value
 
 
+def compile_pattern(pattern):
+    """
+    Turns a machine tag pattern into filter() arguments for
+    MachineTaggedItem. Namespace, predicate and value can each be '*', and a
+    value ending with '*' matches a prefix: 'services:*=flickr',
+    '*:*=simon', 'im:django=*' or 'profile:blog=http://*'. Parts that match
+    anything are left out of the query instead of becoming LIKE patterns, so
+    that the rest can use the (namespace, predicate, value) index or the
+    value index.
+    """
+    match = _pattern_re.match(pattern)
+    assert match, 'pattern must be of format namespace:predicate=value'
+    namespace, predicate, value = match.groups()
+    filters = {}
+    if namespace != WILDCARD:
+        filters['namespace'] = namespace
+    if predicate != WILDCARD:
+        filters['predicate'] = predicate
+    if value[:1] == '"' and value[-1:] == '"' and len(value) > 1:
+        filters['value'] = value[1:-1].replace(r'\"', '"')
+    elif value == WILDCARD:
+        pass
+    elif value.endswith(WILDCARD):
+        filters['value__startswith'] = value[:-1]
+    else:
+        filters['value'] = value
+    return filters
+
+
+def tags_matching(pattern):
+    """
+    Returns the machine tags matching a pattern, see compile_pattern().
+    They're unordered: sorting on the default ordering would tempt the
+    database into scanning the (namespace, predicate, value) index.
+    """
+    return MachineTaggedItem.objects.filter(
+        **compile_pattern(pattern)).order_by()
+
+
+def tagged_with(queryset, pattern):
+    """
+    Narrows a queryset down to the objects having a machine tag that
+    matches a pattern, with a subquery.
+    """
+    content_type = ContentType.objects.get_for_model(queryset.model)
+    return queryset.filter(pk__in=tags_matching(pattern).filter(
+        content_type=content_type).values('object_id'))
+
+
 def tag_exists(*args):
     namespace, predicate, value = parse_machinetag(*args)
     return MachineTaggedItem.objects.filter(
@@ -195,6 +195,21 @@ LOGGING = {
 
 GEONAMES_USERNAME = environ.get('GEONAMES_USERNAME', 'brutasse')
 
+# Map clustering engine: 'closestpair', 'indexed' or 'grid'
+CLUSTERING_ENGINE = environ.get('CLUSTERING_ENGINE', 'closestpair')
+# Worker processes for full reclusters, 1 runs the engine in-process
+CLUSTERING_WORKERS = int(environ.get('CLUSTERING_WORKERS', 1))
+# Recompute the affected grid cells whenever someone joins, moves or leaves.
+# Only with the 'grid' engine, whose cells these are, after a full recluster.
+CLUSTERING_INCREMENTAL = bool(environ.get('CLUSTERING_INCREMENTAL', False))
+# How long browsers, proxies and the cache may keep cluster tiles
+CLUSTER_TILE_MAX_AGE = 24 * 60 * 60
+# Pre-rendered PNG cluster tiles (manage.py render_tiles), up to that zoom.
+# The default directory is ignored by git.
+CLUSTER_TILE_DIR = environ.get('CLUSTER_TILE_DIR',
+                               os.path.join(OUR_ROOT, 'tiles'))
+CLUSTER_TILE_RENDER_ZOOM = int(environ.get('CLUSTER_TILE_RENDER_ZOOM', 6))
+
 if 'CANONICAL_HOSTNAME' in environ:
     CANONICAL_HOSTNAME = environ['CANONICAL_HOSTNAME']
     ALLOWED_HOSTS = [CANONICAL_HOSTNAME]
@@ -252,16 +267,15 @@ if 'REDISTOGO_URL' in environ:
             'VERSION': environ.get('CACHE_VERSION', 0),
         },
     }
-
-
-if 'MEMCACHE_URL' in environ:
+elif 'MEMCACHE_URL' in environ:
     CACHES = {
         'default': {
             'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-            'LOCATION': environ['MEMCACHED_URL'],
+            'LOCATION': environ['MEMCACHE_URL'],
         }
     }
 else:
+    # Only shared within a process, see utils.cache_is_shared()
     CACHES = {
         'default': {
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
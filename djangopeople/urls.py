@@ -7,7 +7,7 @@ from django.http import HttpResponse, HttpResponseGone
 from django.shortcuts import redirect
 from django.template.loader import add_to_builtins
 
-from .djangopeople import views, api
+from .djangopeople import views, api, clustering
 
 add_to_builtins('django.templatetags.i18n')
 add_to_builtins('django.templatetags.future')
@@ -72,8 +72,18 @@ urlpatterns = patterns(
     url(r'^skills/$', views.skill_cloud, name='skill_cloud'),
 
     url(r'^api/stats/$', api.stats, name='stats'),
+    url(r'^api/nearby/$', api.nearby, name='nearby'),
+
+    url(r'^clusters/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.json$',
+        clustering.tile, name='cluster_tile'),
+    url(r'^clusters/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.bin$',
+        clustering.tile, {'format': 'bin'}, name='cluster_tile_binary'),
+    url(r'^clusters/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$',
+        clustering.tile_image, name='cluster_tile_image'),
 
     url(r'^api/irc_lookup/(.*?)/$', api.irc_lookup, name='irc_lookup'),
+    url(r'^api/irc_spotted/$', api.irc_spotted_batch,
+        name='irc_spotted_batch'),
     url(r'^api/irc_spotted/(.*?)/$', api.irc_spotted, name='irc_spotted'),
     url(r'^irc/active/$', views.irc_active, name='irc_active'),
     url(r'^irc/(.*?)/$', api.irc_redirect, name='irc_redirect'),
@@ -0,0 +1,118 @@
+import json
+import random
+
+from mock import patch
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from djangopeople.djangopeople import nearest
+from djangopeople.djangopeople.models import Country, DjangoPerson
+
+
+class ApiTest(TestCase):
+    fixtures = ['test_data']
+
+    def tearDown(self):  # noqa
+        cache.clear()
+
+    def test_irc_spotted_batch(self):
+        url = reverse('irc_spotted_batch')
+        response = self.client.post(url, {'sekrit': 'wrong password',
+                                          'nick': ['davieboy']})
+        self.assertContains(response, 'BAD_SEKRIT')
+
+        louis = DjangoPerson.objects.get(pk=2)
+        louis.add_machinetag('im', 'django', 'satchmo')
+        louis.add_machinetag('privacy', 'irctrack', 'private')
+        data = {'sekrit': settings.API_PASSWORD,
+                'nick': ['davieboy', 'satchmo', 'nobody']}
+        with self.assertNumQueries(3):
+            response = self.client.post(url, data)
+        self.assertEqual(json.loads(response.content), {
+            'davieboy': 'FIRST_TIME_SEEN',
+            'satchmo': 'TRACKING_FORBIDDEN',
+            'nobody': 'NO_MATCH',
+        })
+        self.assertTrue(DjangoPerson.objects.get(pk=1).last_active_on_irc)
+        self.assertEqual(DjangoPerson.objects.get(pk=2).last_active_on_irc,
+                         None)
+
+        # Everyone was seen. Nicks come from the cache when it's shared.
+        cache.clear()
+        with patch('djangopeople.djangopeople.utils.cache_is_shared',
+                   lambda: True):
+            call_command('warm_irc_nicks')
+            with self.assertNumQueries(2):
+                response = self.client.post(
+                    url, {'sekrit': settings.API_PASSWORD,
+                          'nick': ['davieboy']})
+        self.assertEqual(json.loads(response.content),
+                         {'davieboy': 'TRACKED'})
+
+    def test_nearby(self):
+        rand = random.Random(0)
+        france = Country.objects.get(iso_code='FR')
+        for i in range(30):
+            user = User.objects.create_user('user%s' % i, '', 'pass')
+            DjangoPerson.objects.create(
+                user=user, country=france, location_description='',
+                latitude=48.85 + rand.gauss(0, 1),
+                longitude=2.35 + rand.gauss(0, 1),
+            )
+        people = DjangoPerson.objects.all()
+        miles = nearest.haversine(48.85, 2.35,
+                                  [p.latitude for p in people],
+                                  [p.longitude for p in people])
+        by_distance = [p.user.username for d, p in sorted(zip(miles, people))]
+        within = [p.user.username for d, p in sorted(zip(miles, people))
+                  if d * 1.609344 <= 100]
+
+        def get(**params):
+            response = self.client.get(reverse('nearby'), params)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            return json.loads(''.join(response.streaming_content))
+
+        url = reverse('nearby')
+        content = get(lat=48.85, lon=2.35, radius=100, limit=5)
+        self.assertEqual(content['count'], len(within))
+        self.assertEqual([p['username'] for p in content['results']],
+                         within[:5])
+        self.assertTrue('offset=5' in content['next'])
+        self.assertTrue(all(p['distance_km'] <= 100
+                            for p in content['results']))
+
+        # Following the pages gets everyone in the circle
+        usernames = []
+        next_url = '%s?lat=48.85&lon=2.35&radius=100&limit=5' % url
+        while next_url:
+            content = json.loads(''.join(
+                self.client.get(next_url).streaming_content))
+            usernames.extend(p['username'] for p in content['results'])
+            next_url = content['next']
+        self.assertEqual(usernames, within)
+
+        content = get(lat=48.85, lon=2.35, k=7)
+        self.assertEqual(content['count'], 7)
+        self.assertEqual(content['next'], None)
+        self.assertEqual([p['username'] for p in content['results']],
+                         by_distance[:7])
+        result = content['results'][0]
+        self.assertEqual(result['country'], 'FR')
+        self.assertTrue(result['url'].startswith('http://testserver/'))
+
+        # Everyone, from the other side of the world
+        content = get(lat=-48.85, lon=-177.65, radius=30000)
+        self.assertEqual(content['count'], 32)
+
+        for params in ({}, {'lat': 'x', 'lon': 2, 'k': 7},
+                       {'lat': 48.85, 'lon': 2.35},
+                       {'lat': 48.85, 'lon': 2.35, 'k': 7, 'radius': 10},
+                       {'lat': 91, 'lon': 2.35, 'k': 7},
+                       {'lat': 48.85, 'lon': 2.35, 'k': 7, 'limit': 5000}):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
@@ -0,0 +1,565 @@
+import itertools
+import json
+import math
+import random
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from unittest import skipIf
+
+from mock import ANY, Mock, patch
+from redis_cache import RedisCache
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from djangopeople.djangopeople import clustering
+from djangopeople.djangopeople.models import (ClusteredPoint,
+                                              ClusteredPointShadow,
+                                              ClusterUpdate, Country,
+                                              DjangoPerson)
+from djangopeople.clusterlizard import clusterer, pyclosestpair
+from djangopeople.clusterlizard.clusterer import Clusterer, CompactCluster
+from djangopeople.clusterlizard.grid import GridClusterer
+from djangopeople.clusterlizard.indexed import IndexedClusterer
+from djangopeople.clusterlizard.parallel import ParallelClusterer, partition
+from djangopeople.clusterlizard.utils import render
+
+
+def random_points(n, seed=42):
+    rand = random.Random(seed)
+    return [(rand.uniform(-2000000, 2000000), rand.uniform(-2000000, 2000000),
+             i) for i in range(n)]
+
+
+def cluster_output(clusterer, points, **kwargs):
+    """
+    Runs a clustering engine and returns, for each zoom level, the sorted
+    list of member ids of every cluster.
+    """
+    result = {}
+
+    def output(clusters, zoom):
+        result[zoom] = sorted(sorted(c.ids) for c in clusters)
+    clusterer(iter(points), output, **kwargs).run()
+    return result
+
+
+class ClusteringTest(TestCase):
+    def test_closest_pair(self):
+        def brute_force(points):
+            return min((math.hypot(p[0] - q[0], p[1] - q[1]),
+                        sorted([p[2], q[2]]))
+                       for p, q in itertools.combinations(points, 2))
+
+        # Two points a third of a metre apart, far from the origin
+        points = random_points(300) + [(5e5 + .25, 5e5, 300),
+                                       (5e5, 5e5 + .25, 301)]
+        expected = brute_force(points)
+        self.assertEqual(expected[1], [300, 301])
+        xs = array('d', [x for x, y, d in points])
+        ys = array('d', [y for x, y, d in points])
+        # Two people at the same place
+        coincident = points + [(-3e5, 7e5, 302), (-3e5, 7e5, 303)]
+        for module in (clusterer, pyclosestpair):
+            d, p1, p2 = module.closest_pair(list(points))
+            self.assertEqual((d, sorted([p1[2], p2[2]])), expected)
+            d, i, j = module.closest_indices(xs, ys)
+            self.assertEqual((d, sorted([i, j])), expected)
+            d, i, j = module.closest_indices(xs, ys, range(300))
+            self.assertEqual((d, sorted([i, j])), brute_force(points[:300]))
+            for n in (2, 3, len(coincident)):
+                d, p1, p2 = module.closest_pair(list(coincident[-n:]))
+                self.assertEqual((d, sorted([p1[2], p2[2]])),
+                                 (0.0, [302, 303]))
+
+    def test_indexed_engine(self):
+        points = random_points(200)
+        expected = cluster_output(Clusterer, points)
+        self.assertEqual(sorted(expected.keys()), range(18))
+        self.assertEqual(cluster_output(IndexedClusterer, points), expected)
+
+    def test_indexed_engine_dense(self):
+        # Coincident people and a crowd within a few metres, which used to
+        # pile up in a single grid cell
+        rand = random.Random(42)
+        coords = [(x, y) for x, y, d in random_points(50)]
+        coords += coords[:10] * 3
+        coords += [(1e5 + rand.uniform(0, 30), 1e5 + rand.uniform(0, 30))
+                   for i in range(100)]
+        points = [(x, y, i) for i, (x, y) in enumerate(coords)]
+        expected = cluster_output(Clusterer, points)
+        engine = IndexedClusterer(iter(points), lambda clusters, zoom: None)
+        self.assertEqual(cluster_output(IndexedClusterer, points), expected)
+        engine.run()
+        self.assertEqual(engine.merges, len(points) - len(expected[0]))
+
+    def test_compact_cluster(self):
+        points = random_points(200)
+        expected = cluster_output(Clusterer, points)
+        for engine in (Clusterer, IndexedClusterer):
+            self.assertEqual(cluster_output(engine, points,
+                                            cluster_class=CompactCluster),
+                             expected)
+
+        a = CompactCluster.from_point(0, 0, 1)
+        b = CompactCluster.from_point(4, 2, 2).merge(
+            CompactCluster.from_point(4, 4, 3))
+        merged = a.merge(b)
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(merged.mean, (8 / 3., 2.))
+        self.assertEqual(sorted(merged.ids), [1, 2, 3])
+
+    def test_grid_engine(self):
+        points = random_points(500)
+        result = cluster_output(GridClusterer, points,
+                                cluster_class=CompactCluster)
+        engine = GridClusterer(None, None)
+        for zoom in range(18):
+            cells = {}
+            for x, y, d in points:
+                cells.setdefault(engine.cell((x, y), zoom), []).append(d)
+            self.assertEqual(result[zoom], sorted(cells.values()))
+            if zoom < 17:
+                # Every cluster is made of whole clusters of the zoom above
+                parents = dict((d, tuple(ids)) for ids in result[zoom]
+                               for d in ids)
+                for ids in result[zoom + 1]:
+                    self.assertEqual(len(set(parents[d] for d in ids)), 1)
+        self.assertTrue(len(result[0]) < len(result[17]))
+
+    def test_instrumentation(self):
+        points = random_points(300)
+        for engine in (Clusterer, IndexedClusterer, GridClusterer):
+            progress = []
+            stats = []
+            output = []
+            engine(iter(points), lambda c, zoom: output.append(len(c)),
+                   lambda *args: progress.append(args),
+                   cluster_class=CompactCluster, stats=stats.append,
+                   progress_interval=3600).run()
+            # Rate-limited to the very first merge
+            self.assertEqual(len(progress), 1)
+            self.assertEqual([s['zoom'] for s in stats], range(17, -1, -1))
+            self.assertEqual([s['clusters'] for s in stats], output)
+            self.assertEqual(sum(s['merges'] for s in stats),
+                             len(points) - output[-1])
+            for s in stats:
+                self.assertTrue(s['seconds'] >= 0)
+                self.assertTrue(s['peak_rss_mb'] > 0)
+                self.assertEqual(s['index_rebuilds'],
+                                 0 if engine is Clusterer else 1)
+
+    def test_parallel_engine(self):
+        points = random_points(300)
+        for engine in (Clusterer, IndexedClusterer, GridClusterer):
+            expected = cluster_output(engine, points,
+                                      cluster_class=CompactCluster)
+            self.assertEqual(cluster_output(ParallelClusterer, points,
+                                            cluster_class=CompactCluster,
+                                            engine=engine, workers=2),
+                             expected)
+
+        clusters = [CompactCluster.from_point(x, y, d) for x, y, d in
+                    [(0, 0, 1), (5, 50, 2), (20, 0, 3), (20, 5, 4)]]
+        groups = partition(clusters, 10)
+        self.assertEqual(sorted(sorted(c.ids[0] for c in group)
+                                for group in groups), [[1], [2], [3, 4]])
+
+
+class ClusterStoreTest(TestCase):
+    fixtures = ['test_data']
+
+    @patch('djangopeople.djangopeople.clustering.progress')
+    def test_full_run(self, progress):
+        ClusteredPoint.objects.create(latitude=1, longitude=1, zoom=3,
+                                      number=12)
+        with CaptureQueriesContext(connection) as queries:
+            clustering.run()
+        inserts = [q for q in queries.captured_queries
+                   if 'INSERT INTO' in q['sql'] and
+                   ClusteredPointShadow._meta.db_table in q['sql']]
+        self.assertEqual(len(inserts), 18)  # One per zoom level
+        self.assertFalse(ClusteredPoint.objects.filter(number=12).exists())
+        self.assertFalse(ClusteredPointShadow.objects.exists())
+        self.assertEqual(
+            list(ClusteredPoint.objects.values_list('zoom', 'number')),
+            [(zoom, 2) for zoom in range(17, -1, -1)],
+        )
+
+    @patch('djangopeople.djangopeople.clustering.progress')
+    def test_recluster_stats(self, progress):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call_command('recluster', stats=path)
+            call_command('recluster', stats=path)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+        self.assertEqual(len(lines), 36)
+        self.assertEqual([line['zoom'] for line in lines],
+                         range(17, -1, -1) * 2)
+        self.assertEqual((lines[0]['clusters'], lines[0]['merges']), (1, 1))
+        self.assertEqual(lines[0]['engine'], 'closestpair')
+
+    def test_input_generator(self):
+        expected = []
+        for person in DjangoPerson.objects.order_by('pk'):
+            x, y = clustering.latlong_to_mercator(person.latitude,
+                                                  person.longitude)
+            expected.append((x, y, person.id))
+
+        with self.assertNumQueries(2):  # One chunk, one empty chunk
+            points = list(clustering.input_generator())
+        with self.assertNumQueries(3):
+            self.assertEqual(list(clustering.input_generator(chunk_size=1)),
+                             points)
+        with patch('djangopeople.djangopeople.clustering.numpy', None):
+            self.assertEqual(list(clustering.input_generator()), expected)
+        self.assertEqual(len(points), len(expected))
+        for point, (x, y, id) in zip(points, expected):
+            self.assertAlmostEqual(point[0], x, places=6)
+            self.assertAlmostEqual(point[1], y, places=6)
+            self.assertEqual(point[2], id)
+
+
+@override_settings(CLUSTERING_ENGINE='grid', CLUSTERING_INCREMENTAL=True)
+class IncrementalClusteringTest(TestCase):
+    fixtures = ['test_data']
+
+    def rebuild(self):
+        ClusteredPoint.objects.all().delete()
+        GridClusterer(clustering.input_generator(), clustering.save_clusters,
+                      cluster_class=CompactCluster).run()
+
+    def assert_up_to_date(self):
+        fields = ('zoom', 'number', 'djangoperson_id', 'latitude',
+                  'longitude')
+        incremental = sorted(ClusteredPoint.objects.values_list(*fields))
+        self.rebuild()
+        rebuilt = sorted(ClusteredPoint.objects.values_list(*fields))
+        self.assertEqual(len(incremental), len(rebuilt))
+        for got, expected in zip(incremental, rebuilt):
+            self.assertEqual(got[:3], expected[:3])
+            self.assertAlmostEqual(got[3], expected[3], places=6)
+            self.assertAlmostEqual(got[4], expected[4], places=6)
+
+    def test_incremental_updates(self):
+        self.rebuild()
+        self.assertEqual(ClusteredPoint.objects.filter(zoom=0).get().number,
+                         2)
+
+        user = User.objects.create_user('bill', 'bill@example.com', 'pass')
+        bill = DjangoPerson.objects.create(
+            user=user,
+            country=Country.objects.get(iso_code='FR'),
+            latitude=48.8566,
+            longitude=2.3522,
+            location_description='Paris',
+        )
+        self.assert_up_to_date()
+
+        bill.latitude, bill.longitude = 45.764, 4.8357
+        bill.save()
+        self.assert_up_to_date()
+        # Only logged for a full run in progress
+        self.assertFalse(ClusterUpdate.objects.exists())
+
+        # Saving without moving leaves the clusters alone
+        with self.assertNumQueries(3):
+            bill.save()
+
+        # Deferred coordinates are treated as a new location
+        bill = DjangoPerson.objects.defer('latitude', 'longitude').get(
+            pk=bill.pk)
+        with patch('djangopeople.djangopeople.clustering.'
+                   'update_clusters') as update_clusters:
+            bill.save()
+        update_clusters.assert_called_once_with(None, (45.764, 4.8357))
+
+        # Clusters are updated once the person is saved, outside of its
+        # transaction
+        depth = len(connection.savepoint_ids)
+
+        def update_clusters(old, new):
+            self.assertEqual(len(connection.savepoint_ids), depth)
+            real_update_clusters(old, new)
+        real_update_clusters = clustering.update_clusters
+        bill.latitude = 45.75
+        with patch('djangopeople.djangopeople.clustering.update_clusters',
+                   update_clusters):
+            bill.save()
+
+        dave = DjangoPerson.objects.get(pk=1)
+        dave.delete()
+        self.assert_up_to_date()
+        self.assertEqual(
+            ClusteredPoint.objects.filter(zoom=17, number=1).count(), 2)
+
+    def test_updates_during_full_run(self):
+        def swap_tables():
+            # Someone joins after the full run read everyone
+            user = User.objects.create_user('bill', 'bill@example.com',
+                                            'pass')
+            DjangoPerson.objects.create(
+                user=user,
+                country=Country.objects.get(iso_code='FR'),
+                latitude=48.8566,
+                longitude=2.3522,
+                location_description='Paris',
+            )
+            # Logged after the row marking the start of the run
+            self.assertEqual(ClusterUpdate.objects.count(), 2)
+            real_swap_tables()
+        real_swap_tables = clustering.swap_tables
+
+        with patch('djangopeople.djangopeople.clustering.swap_tables',
+                   swap_tables), \
+                patch('djangopeople.djangopeople.clustering.progress'):
+            clustering.run()
+        self.assertEqual(ClusteredPoint.objects.filter(zoom=0).get().number,
+                         3)
+        self.assertFalse(ClusterUpdate.objects.exists())
+        self.assert_up_to_date()
+
+    @override_settings(CLUSTERING_ENGINE='closestpair')
+    def test_other_engines(self):
+        # Grid cells would overwrite the clusters of the other engines
+        dave = DjangoPerson.objects.get(pk=1)
+        dave.latitude = 45.75
+        with patch('djangopeople.djangopeople.clustering.'
+                   'update_clusters') as update_clusters:
+            dave.save()
+            dave.delete()
+        self.assertFalse(update_clusters.called)
+
+
+@override_settings(CLUSTERING_ENGINE='grid', CLUSTERING_INCREMENTAL=True)
+class ClusterTileTest(TestCase):
+    fixtures = ['test_data']
+
+    def setUp(self):  # noqa
+        cache.clear()
+        self.shared_cache = patch(
+            'djangopeople.djangopeople.utils.cache_is_shared', lambda: True)
+        self.shared_cache.start()
+        with patch('djangopeople.djangopeople.clustering.progress'):
+            clustering.run()
+
+    def tearDown(self):  # noqa
+        self.shared_cache.stop()
+
+    def test_tile(self):
+        url = reverse('cluster_tile', args=[0, 0, 0])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertTrue('max-age=86400' in response['Cache-Control'])
+        [(long, lat, number, profile)] = json.loads(response.content)
+        self.assertEqual(number, 2)
+        self.assertEqual(profile, None)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Europe is in the north east tile at zoom 1
+        url = reverse('cluster_tile', args=[1, 1, 0])
+        self.assertEqual(len(json.loads(self.client.get(url).content)), 1)
+        url = reverse('cluster_tile', args=[1, 0, 1])
+        self.assertEqual(json.loads(self.client.get(url).content), [])
+
+        for args in ([18, 0, 0], [1, 2, 0], [2, 0, 4]):
+            url = reverse('cluster_tile', args=args)
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_binary_format(self):
+        user = User.objects.create_user('bill', 'bill@example.com', 'pass')
+        DjangoPerson.objects.create(
+            user=user,
+            country=Country.objects.get(iso_code='US'),
+            latitude=40.7127,
+            longitude=-74.0059,
+            location_description='New York',
+        )
+        x, y = clustering.mercator_tile(
+            *clustering.latlong_to_mercator(40.7127, -74.0059), zoom=17)
+        url = reverse('cluster_tile_binary', args=[17, x, y])
+        self.assertTrue(url.endswith('.bin'))
+
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(response.content, struct.pack(
+            '<IiiI', 1, -74005900, 40712700, 1) + 'bill')
+        json_response = self.client.get(
+            reverse('cluster_tile', args=[17, x, y]),
+            HTTP_ACCEPT='application/octet-stream')
+        self.assertEqual(json_response['Content-Type'], 'application/json')
+        [(long, lat, number, profile)] = json.loads(json_response.content)
+        self.assertEqual((number, profile), (1, '/bill/'))
+        self.assertAlmostEqual(lat, 40.7127)
+        self.assertNotEqual(response['ETag'], json_response['ETag'])
+
+        rows = [(2.35, 48.85, 3, None), (-0.1, 51.5, 1, u'jos\xe9'),
+                (139.7, 35.7, 1, None)]
+        payload = clustering.encode_binary(rows)
+        self.assertEqual(struct.unpack('<IiiIiiIiiI', payload[:40]),
+                         (3, 2350000, 48850000, 3, -100000, 51500000, 1,
+                          139700000, 35700000, 1))
+        self.assertEqual(payload[40:].decode('utf-8'), u'jos\xe9\n')
+
+    def test_one_query_per_response(self):
+        france = Country.objects.get(iso_code='FR')
+        for i in range(10):
+            user = User.objects.create_user('user%s' % i, '', 'pass')
+            DjangoPerson.objects.create(user=user, country=france,
+                                        latitude=45 + i * 0.1,
+                                        longitude=2, location_description='')
+        with patch('djangopeople.djangopeople.clustering.progress'):
+            clustering.run()
+        cache.clear()
+
+        request = RequestFactory().get('/')
+        with self.assertNumQueries(1):
+            response = clustering.as_json(request, 3, 44, 1, 47, 17)
+        clusters = json.loads(response.content)
+        self.assertEqual(len(clusters), 10)
+        self.assertEqual(set(url for _, _, _, url in clusters),
+                         set('/user%s/' % i for i in range(10)))
+
+        x, y = clustering.mercator_tile(
+            *clustering.latlong_to_mercator(45.5, 2), zoom=17)
+        url = reverse('cluster_tile_binary', args=[17, x, y])
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertTrue(response.content.endswith('user5'))
+
+    def test_tiles_are_precomputed(self):
+        with self.assertNumQueries(0):
+            for zoom in range(18):
+                x, y = clustering.mercator_tile(
+                    *clustering.latlong_to_mercator(50.03597367219547,
+                                                    14.9853515625),
+                    zoom=zoom)
+                response = self.client.get(reverse('cluster_tile',
+                                                   args=[zoom, x, y]))
+                self.assertEqual(json.loads(response.content)[0][2], 2)
+
+    def test_invalidation(self):
+        url = reverse('cluster_tile', args=[0, 0, 0])
+        etag = self.client.get(url)['ETag']
+
+        user = User.objects.create_user('bill', 'bill@example.com', 'pass')
+        DjangoPerson.objects.create(
+            user=user,
+            country=Country.objects.get(iso_code='US'),
+            latitude=40.7127,
+            longitude=-74.0059,
+            location_description='New York',
+        )
+        response = self.client.get(url)
+        self.assertNotEqual(response['ETag'], etag)
+        clusters = json.loads(response.content)
+        self.assertEqual(sum(number for _, _, number, _ in clusters), 3)
+
+    @patch('djangopeople.djangopeople.clustering.cache')
+    def test_tiles_expire(self, cache):
+        cache.get.return_value = None
+        clustering.precompute_tiles()
+        clustering.get_tile(0, 0, 0, 'json')
+        self.assertTrue(cache.set_many.call_args_list)
+        for args, kwargs in cache.set_many.call_args_list:
+            self.assertEqual(args[1], 24 * 60 * 60)
+
+    def test_generation_timeout(self):
+        # The Redis backend wants its timeouts in seconds, never None
+        redis = RedisCache('127.0.0.1:6379', {})
+        redis._client = Mock()
+        with patch.object(clustering, 'cache', redis):
+            clustering.tile_generation(new=True)
+        redis._client.setex.assert_called_once_with(
+            ANY, ANY, clustering.GENERATION_TIMEOUT)
+
+    def test_local_cache(self):
+        self.shared_cache.stop()
+        try:
+            with patch('djangopeople.djangopeople.clustering.cache') as local:
+                clustering.precompute_tiles()
+                self.assertEqual(clustering.tile_generation(new=True), 0)
+            # Other processes wouldn't see the new generation
+            self.assertFalse(local.set.called)
+            self.assertFalse(local.set_many.called)
+        finally:
+            self.shared_cache.start()
+
+
+class RenderTilesTest(TestCase):
+    fixtures = ['test_data']
+
+    def setUp(self):  # noqa
+        self.tile_dir = tempfile.mkdtemp()
+        self.settings = override_settings(CLUSTER_TILE_DIR=self.tile_dir,
+                                          CLUSTERING_ENGINE='grid')
+        self.settings.enable()
+        with patch('djangopeople.djangopeople.clustering.progress'):
+            clustering.run()
+
+    def tearDown(self):  # noqa
+        self.settings.disable()
+        shutil.rmtree(self.tile_dir)
+
+    @patch('djangopeople.djangopeople.clustering.write_tile')
+    def test_only_changed_tiles_are_rendered(self, write_tile):
+        self.assertEqual(clustering.render_tiles(3), (4, 0))
+        paths = [args[0] for (args,), kwargs in write_tile.call_args_list]
+        self.assertEqual(len(paths), 5)
+        self.assertTrue(paths[-1].endswith('blank.png'))
+        x, y = render.touched_tiles(*clustering.latlong_to_mercator(
+            50.03597367219547, 14.9853515625) + (2, 3))[0]
+        self.assertTrue(clustering.tile_image_path(3, x, y) in paths)
+
+        write_tile.reset_mock()
+        self.assertEqual(clustering.render_tiles(3), (0, 0))
+
+        # Moving the cluster re-renders its old and new tiles
+        ClusteredPoint.objects.filter(zoom=3).update(latitude=-33.87,
+                                                     longitude=151.2)
+        self.assertEqual(clustering.render_tiles(3), (1, 1))
+        self.assertEqual(clustering.render_tiles(3, force=True), (4, 0))
+
+        # Forcing still removes the tiles left without clusters
+        ClusteredPoint.objects.filter(zoom=3).update(latitude=50.04,
+                                                     longitude=14.99)
+        self.assertEqual(clustering.render_tiles(3, force=True), (4, 1))
+
+    def test_tile_image(self):
+        url = reverse('cluster_tile_image', args=[0, 0, 0])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        path = clustering.tile_image_path(0, 0, 0)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('png')
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response.content, 'png')
+        url = reverse('cluster_tile_image', args=[7, 0, 0])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    @skipIf(render.cairo is None, "pycairo isn't installed")
+    def test_render(self):
+        clustering.render_tiles(1)
+        with open(clustering.tile_image_path(1, 1, 0), 'rb') as f:
+            self.assertTrue(f.read().startswith('\x89PNG'))
+        url = reverse('cluster_tile_image', args=[1, 0, 1])
+        response = self.client.get(url)
+        with open(os.path.join(self.tile_dir, 'blank.png'), 'rb') as f:
+            self.assertEqual(response.content, f.read())
@@ -1,12 +1,39 @@
+import copy
+import random
+from cStringIO import StringIO
+
+from geopy import distance
+from mock import ANY, Mock, patch
+from redis_cache import RedisCache
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import DatabaseError, connection
+from django.db.backends.postgresql_psycopg2 import (
+    creation as postgresql_creation, operations as postgresql_operations)
+from django.test.utils import CaptureQueriesContext
 from django.test import TestCase
 
+from djangopeople.djangopeople import (counters, geohash, ircnicks, nearest,
+                                       neighbours)
+from djangopeople.djangopeople.management.commands import upgrade_schema
 from djangopeople.djangopeople.models import (Country, DjangoPerson, Region,
-                                              CountrySite, PortfolioSite)
+                                              CountrySite, PortfolioSite,
+                                              NearestNeighbour)
+from djangopeople.machinetags.models import (MachineTaggedItem,
+                                             compile_pattern, tagged_with,
+                                             tags_matching)
 
 
 class DjangoPeopleUnitTest(TestCase):
     fixtures = ['test_data']
 
+    def tearDown(self):  # noqa
+        # Cached profile views and IRC nicks outlive the test's transaction
+        cache.clear()
+
     def test_region(self):
         ak = Region.objects.get(pk=36)
         self.assertEquals(ak.__unicode__(), u'Alaska')
@@ -48,3 +75,430 @@ class DjangoPeopleUnitTest(TestCase):
             louis.location_description_html(),
             'Paris, France')
         self.assertEquals(louis.get_absolute_url(), '/satchmo/')
+
+    def test_num_people(self):
+        def counts():
+            countries = Country.objects.filter(
+                iso_code__in=['AT', 'FR', 'US']).order_by('iso_code')
+            regions = Region.objects.filter(pk__in=[32, 36]).order_by('pk')
+            return (list(countries.values_list('num_people', flat=True)) +
+                    list(regions.values_list('num_people', flat=True)))
+
+        # The fixture people aren't counted, Hawaii starts at 1
+        self.assertEqual(counts(), [0, 0, 0, 1, 0])
+        us = Country.objects.get(iso_code='US')
+        hawaii, alaska = Region.objects.get(pk=32), Region.objects.get(pk=36)
+        user = User.objects.create_user('bill', '', 'pass')
+        bill = DjangoPerson.objects.create(
+            user=user, country=us, region=hawaii, location_description='',
+            latitude=21.3, longitude=-157.8)
+        self.assertEqual(counts(), [0, 0, 1, 2, 0])
+
+        # Saves that don't move people leave the counters alone
+        bill = DjangoPerson.objects.get(pk=bill.pk)
+        with CaptureQueriesContext(connection) as queries:
+            bill.bio = 'Aloha'
+            bill.save()
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'num_people' in q['sql']])
+        # Nor do deferred countries and regions, unknown until then
+        DjangoPerson.objects.defer('country', 'region').get(
+            pk=bill.pk).save()
+        self.assertEqual(counts(), [0, 0, 1, 2, 0])
+
+        bill.region = alaska
+        bill.save()
+        self.assertEqual(counts(), [0, 0, 1, 1, 1])
+
+        bill.country = Country.objects.get(iso_code='FR')
+        bill.region = None
+        bill.save()
+        self.assertEqual(counts(), [0, 1, 0, 1, 0])
+
+        DjangoPerson.objects.get(pk=1).delete()
+        bill.delete()
+        self.assertEqual(counts(), [-1, 0, 0, 1, 0])
+
+    def test_geohash(self):
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11),
+                         'u4pruydqqvj')
+        south, west, north, east = geohash.decode('u4pruydqqvj')
+        self.assertTrue(south < 57.64911 < north)
+        self.assertTrue(west < 10.40744 < east)
+        self.assertEqual(geohash.neighbours('u4pru'), [
+            'u4pre', 'u4prg', 'u4prs', 'u4prt', 'u4pru', 'u4prv', 'u4r25',
+            'u4r2h', 'u4r2j'])
+        # Wraps around the antimeridian, stops at the poles
+        self.assertEqual(geohash.neighbours('b'),
+                         ['8', '9', 'b', 'c', 'x', 'z'])
+
+        DjangoPerson.objects.update(geohash='')
+        call_command('fix_geohashes')
+        self.assertEqual(set(DjangoPerson.objects.values_list('geohash',
+                                                              flat=True)),
+                         set(['u2fsthb08j81']))
+
+    def test_upgrade_schema(self):
+        statements = upgrade_schema.add_column(DjangoPerson, 'geohash')
+        self.assertTrue(statements[0].startswith('ALTER TABLE'))
+        self.assertTrue(statements[0].endswith("NOT NULL DEFAULT ''"))
+        self.assertTrue(statements[1].startswith('CREATE INDEX'))
+        self.assertTrue((DjangoPerson, 'privacy_irctrack') in
+                        upgrade_schema.COLUMNS)
+
+        # Nothing to add to an up-to-date database
+        stdout = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('upgrade_schema', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'ALTER' in q['sql'] or 'INDEX' in q['sql']])
+
+        # Machine tags as they were before their composite indexes
+        cursor = connection.cursor()
+        [(together, sql)] = upgrade_schema.create_indexes(
+            MachineTaggedItem, MachineTaggedItem._meta.index_together[0])
+        cursor.execute(upgrade_schema.drop_index(MachineTaggedItem,
+                                                 together))
+        obsolete = []
+        for model, name in upgrade_schema.OBSOLETE_INDEXES:
+            field = copy.copy(model._meta.get_field(name))
+            field.db_index = True
+            for sql in connection.creation.sql_indexes_for_field(
+                    model, field, no_style()):
+                cursor.execute(sql)
+            obsolete.extend(index for index, sql in
+                            upgrade_schema.field_indexes(model, name))
+        self.assertEqual(len(obsolete), 2)
+        stdout = StringIO()
+        call_command('upgrade_schema', stdout=stdout)
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            'Created index %s' % together] + [
+            'Dropped index %s' % index for index in obsolete])
+        indexes = upgrade_schema.index_names(cursor, MachineTaggedItem)
+        self.assertTrue(together in indexes)
+        self.assertFalse(indexes.intersection(obsolete))
+
+        # PostgreSQL names them after the column, with a second LIKE index
+        postgres = Mock(vendor='postgresql')
+        postgres.ops = postgresql_operations.DatabaseOperations(postgres)
+        postgres.creation = postgresql_creation.DatabaseCreation(postgres)
+        with patch.object(upgrade_schema, 'connection', postgres):
+            self.assertEqual([index for index, sql in
+                              upgrade_schema.field_indexes(MachineTaggedItem,
+                                                           'namespace')], [
+                'machinetags_machinetaggeditem_namespace',
+                'machinetags_machinetaggeditem_namespace_like'])
+
+    def test_get_nearest(self):
+        rand = random.Random(0)
+        france = Country.objects.get(iso_code='FR')
+        for i in range(60):
+            user = User.objects.create_user('user%s' % i, '', 'pass')
+            DjangoPerson.objects.create(
+                user=user, country=france, location_description='',
+                latitude=48.85 + rand.gauss(0, 0.5 if i % 2 else 0.05),
+                longitude=2.35 + rand.gauss(0, 0.5 if i % 2 else 0.05),
+            )
+        people = DjangoPerson.objects.filter(country=france)
+        self.assertTrue(all(len(p.geohash) == 12 for p in people))
+
+        for person in people[:10]:
+            expected = sorted(int(distance.VincentyDistance(
+                (person.latitude, person.longitude),
+                (other.latitude, other.longitude)).miles)
+                for other in people.exclude(pk=person.pk))[:7]
+            found = person.get_nearest(7)
+            self.assertEqual([p.distance_in_miles for p in found], expected)
+
+        # Around central Paris: a count, a few cell lookups and the people
+        person = people.get(user__username='user0')
+        with CaptureQueriesContext(connection) as queries:
+            person.get_nearest(7)
+        self.assertTrue(len(queries) <= 5)
+
+        # Dave, alone in Austria, gets people from the rest of Europe
+        louis = DjangoPerson.objects.get(pk=2)
+        self.assertEqual(len(louis.get_nearest(7)), 7)
+        dave = DjangoPerson.objects.get(pk=1)
+        self.assertEqual(len(dave.get_nearest(100)), 61)
+
+    def test_nearest(self):
+        rand = random.Random(0)
+        rows = [(i, rand.uniform(-60, 70), rand.uniform(-180, 180))
+                for i in range(500)]
+        expected = sorted(
+            (distance.VincentyDistance((45, 5), (lat, long)).miles, pk)
+            for pk, lat, long in rows)[:10]
+        self.assertEqual(nearest.nearest(45, 5, rows, 10), expected)
+        with patch('djangopeople.djangopeople.nearest.numpy', None):
+            self.assertEqual(nearest.nearest(45, 5, rows, 10), expected)
+            # Fewer rows than asked for: all of them, closest first
+            self.assertEqual(nearest.nearest(45, 5, rows[:3], 10), [
+                (distance.VincentyDistance((45, 5), rows[pk][1:]).miles, pk)
+                for pk in (2, 0, 1)])
+        self.assertEqual(nearest.nearest(45, 5, [], 10), [])
+        self.assertAlmostEqual(
+            nearest.haversine(51.5, -0.12, [48.86], [2.35])[0], 212.6,
+            places=1)
+
+    def test_neighbours(self):
+        def table():
+            return list(NearestNeighbour.objects.values_list(
+                'person', 'rank', 'neighbour', 'distance'))
+
+        def assert_up_to_date():
+            current = table()
+            neighbours.rebuild()
+            self.assertEqual(current, table())
+
+        rand = random.Random(0)
+        france = Country.objects.get(iso_code='FR')
+        belgium = Country.objects.get(iso_code='BE')
+        for i in range(20):
+            user = User.objects.create_user('user%s' % i, '', 'pass')
+            DjangoPerson.objects.create(
+                user=user, country=belgium if i < 8 else france,
+                location_description='',
+                latitude=48.85 + rand.gauss(0, 1),
+                longitude=2.35 + rand.gauss(0, 1),
+            )
+        # Saves leave people without any rows alone, like the fixture
+        # people, who fall back to get_nearest()
+        dave = DjangoPerson.objects.get(pk=1)
+        self.assertFalse(dave.neighbours.exists())
+        self.assertEqual(dave.get_neighbours(), dave.get_nearest(7))
+
+        # Saves keep the table up to date once it's built
+        neighbours.rebuild()
+        for person in DjangoPerson.objects.all():
+            self.assertEqual(person.get_neighbours(), person.get_nearest(7))
+        self.assertEqual(NearestNeighbour.objects.count(), 22 * 7)
+
+        # Moving someone
+        person = DjangoPerson.objects.get(user__username='user10')
+        person.latitude, person.longitude = 50.85, 4.35
+        person.save()
+        assert_up_to_date()
+
+        # Belgium goes from 8 to 9 people, enough to use the country only
+        person.country = belgium
+        person.save()
+        self.assertEqual(set(p.country for p in person.get_neighbours()),
+                         set([belgium]))
+        assert_up_to_date()
+
+        # And back to 8 when someone leaves
+        DjangoPerson.objects.get(user__username='user0').delete()
+        assert_up_to_date()
+        self.assertFalse(NearestNeighbour.objects.filter(
+            neighbour__user__username='user0').exists())
+
+        # Profiles read the neighbours in one query
+        person = DjangoPerson.objects.get(user__username='user15')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(person.get_neighbours()), 7)
+
+    def test_fix_counts(self):
+        def counts():
+            return (list(Country.objects.filter(num_people__gt=0).order_by(
+                'pk').values_list('iso_code', 'num_people')),
+                list(Region.objects.filter(num_people__gt=0).order_by(
+                    'pk').values_list('pk', 'num_people')))
+
+        regions = counts()[1]
+        stdout = StringIO()
+        call_command('fix_counts', dry_run=True, stdout=stdout)
+        # The fixture people were loaded without updating the counters
+        self.assertEqual(
+            sorted(stdout.getvalue().splitlines()),
+            ['Country 12: 0 -> 1', 'Country 70: 0 -> 1'] + sorted(
+                'Region %s: %s -> 0' % row for row in regions))
+        self.assertEqual(counts(), ([], regions))
+
+        # Per table, the counts, the rows and a single UPDATE. Plus the
+        # transaction's savepoint and release
+        with self.assertNumQueries(8):
+            call_command('fix_counts', stdout=StringIO())
+        self.assertEqual(counts(), ([('AT', 1), ('FR', 1)], []))
+
+        stdout = StringIO()
+        call_command('fix_counts', dry_run=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
+
+    @patch('djangopeople.djangopeople.utils.cache_is_shared', lambda: True)
+    def test_profile_views(self):
+        cache.clear()
+        stored = DjangoPerson.objects.get(pk=1).profile_views
+        louis = DjangoPerson.objects.get(pk=2).profile_views
+        for i in range(3):
+            counters.increment(1)
+        counters.increment(2)
+        # Counted in the cache, not written yet
+        dave = DjangoPerson.objects.get(pk=1)
+        self.assertEqual(dave.profile_views, stored)
+        self.assertEqual(dave.live_profile_views(), stored + 3)
+
+        # Two people, two different counts: two UPDATEs
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(counters.flush(), 4)
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if 'UPDATE' in q['sql']]), 2)
+        dave = DjangoPerson.objects.get(pk=1)
+        self.assertEqual(dave.profile_views, stored + 3)
+        self.assertEqual(dave.live_profile_views(), stored + 3)
+        self.assertEqual(DjangoPerson.objects.get(pk=2).profile_views,
+                         louis + 1)
+
+        counters.increment(dave.pk)
+        # Views stay pending when they can't be written
+        with patch.object(DjangoPerson.objects, 'filter',
+                          side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, counters.flush)
+        self.assertEqual(dave.live_profile_views(), stored + 4)
+        call_command('flush_profile_views')
+        self.assertEqual(DjangoPerson.objects.get(pk=1).profile_views,
+                         stored + 4)
+        self.assertEqual(counters.flush(), 0)
+
+        # A key evicted after it was read doesn't stop the others
+        counters.increment(1)
+        counters.increment(2)
+        decr = cache.decr
+
+        def evicting_decr(key, delta):
+            if key == counters.view_key(1):
+                cache.delete(key)
+                raise ValueError
+            return decr(key, delta)
+        with patch.object(cache, 'decr', evicting_decr):
+            self.assertEqual(counters.flush(), 2)
+        self.assertEqual(counters.flush(), 0)
+        self.assertEqual(DjangoPerson.objects.get(pk=2).profile_views,
+                         louis + 2)
+
+    @patch('djangopeople.djangopeople.utils.cache_is_shared', lambda: True)
+    def test_profile_views_redis(self):
+        # The Redis backend wants its timeouts in seconds, never None
+        redis = RedisCache('127.0.0.1:6379', {})
+        redis._client = Mock(**{'exists.return_value': False,
+                                'setnx.return_value': True})
+        with patch.object(counters, 'cache', redis):
+            counters.increment(1)
+        redis._client.setnx.assert_called_once_with(ANY, 1)
+        redis._client.expire.assert_called_once_with(ANY, counters.TIMEOUT)
+
+    def test_profile_views_local_cache(self):
+        # Other processes can't see a local memory cache
+        stored = DjangoPerson.objects.get(pk=1).profile_views
+        counters.increment(1)
+        self.assertEqual(DjangoPerson.objects.get(pk=1).profile_views,
+                         stored + 1)
+        self.assertEqual(counters.flush(), 0)
+
+    def test_privacy(self):
+        dave = DjangoPerson.objects.get(pk=1)
+        dave.add_machinetag('privacy', 'irctrack', 'private')
+        dave.add_machinetag('privacy:email=never')
+        dave = DjangoPerson.objects.get(pk=1)
+        self.assertEqual((dave.privacy_irctrack, dave.privacy_email),
+                         ('private', 'never'))
+        with self.assertNumQueries(0):
+            self.assertFalse(dave.irc_tracking_allowed())
+        self.assertEqual(list(DjangoPerson.objects.exclude(
+            privacy_irctrack='private')), [DjangoPerson.objects.get(pk=2)])
+
+        # Backfilling from the machine tags
+        DjangoPerson.objects.update(privacy_irctrack='', privacy_im='public')
+        call_command('fix_privacy')
+        self.assertEqual(list(DjangoPerson.objects.order_by('pk').values_list(
+            'privacy_search', 'privacy_email', 'privacy_im',
+            'privacy_irctrack')),
+            [('', 'never', '', 'private'), ('', '', '', '')])
+
+    @patch('djangopeople.djangopeople.utils.cache_is_shared', lambda: True)
+    def test_irc_nicks(self):
+        cache.clear()
+        with self.assertNumQueries(1):
+            call_command('warm_irc_nicks')
+        with self.assertNumQueries(0):
+            found = ircnicks.lookup(['davieboy'])
+        self.assertEqual(found, {'davieboy': {
+            'pk': 1,
+            'path': '/daveb/',
+            'description': u'Dave Brubeck, Vienna, Austria, Austria',
+            'tracking_allowed': True,
+        }})
+        # Unknown nicks are cached too
+        with self.assertNumQueries(1):
+            self.assertEqual(ircnicks.lookup(['nobody']), {})
+        with self.assertNumQueries(0):
+            self.assertEqual(ircnicks.lookup(['nobody']), {})
+
+        louis = DjangoPerson.objects.get(pk=2)
+        louis.add_machinetag('im', 'django', 'nobody')
+        self.assertEqual(ircnicks.lookup(['nobody'])['nobody']['pk'], 2)
+
+        dave = DjangoPerson.objects.get(pk=1)
+        dave.add_machinetag('privacy', 'irctrack', 'private')
+        self.assertFalse(
+            ircnicks.lookup(['davieboy'])['davieboy']['tracking_allowed'])
+        dave.user.first_name = 'David'
+        dave.user.save()
+        self.assertTrue(ircnicks.lookup(['davieboy'])['davieboy'][
+            'description'].startswith('David Brubeck, '))
+
+        # Changing a user drops all their nicks
+        dave.add_machinetag('im', 'django', 'dave')
+        ircnicks.lookup(['dave'])
+        self.assertEqual(cache.get(ircnicks.user_key(dave.user_id)),
+                         ['dave', 'davieboy'])
+        dave.user.first_name = 'Dave'
+        dave.user.save()
+        for nick in ('dave', 'davieboy'):
+            self.assertEqual(cache.get(ircnicks.nick_key(nick)), None)
+
+        dave.machinetags.filter(namespace='im').delete()
+        self.assertEqual(ircnicks.lookup(['davieboy']), {})
+
+    def test_irc_nicks_local_cache(self):
+        stdout = StringIO()
+        with self.assertNumQueries(0):
+            call_command('warm_irc_nicks', stdout=stdout)
+        self.assertTrue("isn't shared" in stdout.getvalue())
+        for i in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(
+                    ircnicks.lookup(['davieboy'])['davieboy']['pk'], 1)
+        self.assertEqual(cache.get(ircnicks.nick_key('davieboy')), None)
+
+
+class MachineTagsTest(TestCase):
+    fixtures = ['test_data']
+
+    def test_compile_pattern(self):
+        self.assertEqual(compile_pattern('services:*=flickr'),
+                         {'namespace': 'services', 'value': 'flickr'})
+        self.assertEqual(compile_pattern('*:*=davieboy'),
+                         {'value': 'davieboy'})
+        self.assertEqual(compile_pattern('im:django=*'),
+                         {'namespace': 'im', 'predicate': 'django'})
+        self.assertEqual(compile_pattern('profile:blog=http://*'),
+                         {'namespace': 'profile', 'predicate': 'blog',
+                          'value__startswith': 'http://'})
+        self.assertEqual(compile_pattern('im:django="a*"'),
+                         {'namespace': 'im', 'predicate': 'django',
+                          'value': 'a*'})
+        self.assertRaises(AssertionError, compile_pattern, 'services')
+
+    def test_tagged_with(self):
+        people = DjangoPerson.objects.all()
+        dave = DjangoPerson.objects.get(pk=1)
+        for pattern in ('im:django=davieboy', 'im:*=davieboy',
+                        '*:*=davieboy', 'im:django=davie*', '*:*=full-*'):
+            self.assertEqual(list(tagged_with(people, pattern)), [dave])
+        for pattern in ('im:jabber=davieboy', 'services:*=davieboy',
+                        '*:*=davie'):
+            self.assertEqual(list(tagged_with(people, pattern)), [])
+        with self.assertNumQueries(1):
+            self.assertEqual(tags_matching('im:*=*').count(), 1)